@@ -0,0 +1,94 @@
+"""
+Benchmarks for pyicemon.
+
+Usage:
+
+    python benchmarks.py [num_hosts] [num_jobs]
+"""
+from __future__ import print_function
+
+import sys
+import random
+import timeit
+
+import messages
+import binaryframe
+from monitor import Monitor
+from publishers import GraphView, Subscription, cluster_nodes, cluster_links
+
+
+class NullConnection(object):
+    """Connection which sends nowhere."""
+
+    def send_message(self, msg):
+        pass
+
+
+def build_cluster(num_hosts, num_jobs):
+    """Build a Monitor tracking a random cluster."""
+    mon = Monitor(NullConnection())
+    for host_id in range(1, num_hosts + 1):
+        stats = messages.StatsMessage(host_id, b'')
+        stats.data["Name"] = "build-host-{0}".format(host_id)
+        stats.data["IP"] = "10.{0}.{1}.{2}".format(
+            host_id >> 16, (host_id >> 8) & 0xff, host_id & 0xff)
+        stats.data["MaxJobs"] = "16"
+        mon.handleStats(stats)
+
+    for job_id in range(1, num_jobs + 1):
+        client = random.randint(1, num_hosts)
+        host = random.randint(1, num_hosts)
+        mon.handleGetCS(messages.GetCSMessage(
+            b'src/file.c', 0, job_id, client))
+        mon.handleJobBegin(messages.JobBeginMessage(job_id, 0, host))
+
+    return mon
+
+
+def best_time(fn, number=20):
+    """Best time in seconds of one call to fn."""
+    return min(timeit.repeat(fn, number=number, repeat=3)) / number
+
+
+def bench_frames(mon):
+    """Compare the size and encode time of JSON and binary frames."""
+    nodes, links = cluster_nodes(mon), cluster_links(mon)
+    view = GraphView(Subscription())
+    view.update(nodes, links)
+
+    def encode_json():
+        view.nodes = view.links = None
+        return view.build_graph(True)
+
+    def encode_binary():
+        return binaryframe.encode(view, True)
+
+    print("Full frame ({0} nodes, {1} links):".format(len(nodes), len(links)))
+    for name, fn in (("json", encode_json), ("binary", encode_binary)):
+        print("  {0:8} {1:10} bytes {2:8.2f} ms".format(
+            name, len(fn()), best_time(fn) * 1000))
+
+    # A frame where only loads have changed, the common case.
+    view.mark_sent()
+    view.update([dict(n, load=random.randint(0, 100)) for n in nodes], links)
+
+    def encode_json_loads():
+        view.nodes = None
+        return view.build_graph()
+
+    def encode_binary_loads():
+        return binaryframe.encode(view)
+
+    print("Load update frame:")
+    for name, fn in (("json", encode_json_loads),
+                     ("binary", encode_binary_loads)):
+        print("  {0:8} {1:10} bytes {2:8.2f} ms".format(
+            name, len(fn()), best_time(fn) * 1000))
+
+
+if __name__ == "__main__":
+    num_hosts = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_jobs = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    random.seed(0)
+    mon = build_cluster(num_hosts, num_jobs)
+    bench_frames(mon)
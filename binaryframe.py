@@ -0,0 +1,180 @@
+"""
+Compact binary encoding of GraphView frames.
+
+All integers are little-endian.  A frame is a header:
+
+    <version:u8><flags:u8><reserved:u16><node_count:u32>
+
+followed by the sections named in flags, in this order, each padded to a
+multiple of 4 bytes:
+
+    TABLE   <strings_len:u32><strings><ids:u32 * node_count>
+            strings is "name\\0ip\\0name\\0ip..." in UTF-8.  Sent only when the
+            set of nodes changes; later frames refer to nodes by their index
+            in the most recently sent table.
+    LOADS   <load:u16 * node_count>
+            Load percentages in hundredths, so 33.33% is sent as 3333.
+            The JSON frames round loads to the same precision.
+    LINKS   <link_count:u32><source:u32 * n><target:u32 * n><value:u16 * n>
+            sources and targets are table indices.
+    LAYOUT  <x:u16 * node_count><y:u16 * node_count>
+            Positions in the unit square scaled to 0-65534, or 65535 for a
+            node with no position yet.
+    JOBS    <json_len:u32><json>
+            The job events object, as in the JSON frame.
+"""
+import json
+import struct
+
+VERSION = 2
+
+TABLE = 1
+LOADS = 2
+LINKS = 4
+LAYOUT = 8
+JOBS = 16
+
+NO_POSITION = 0xffff
+"""Layout coordinate sent for a node the layout hasn't placed yet."""
+
+LOAD_SCALE = 100
+"""Loads are sent in units of 1/LOAD_SCALE percent."""
+
+HEADER = "<BBHI"
+
+
+def pack_array(typecode, values):
+    """Pack a list of integers as a little-endian array, padded to 4 bytes."""
+    data = struct.pack("<{0}{1}".format(len(values), typecode), *values)
+    return data + b'\x00' * (-len(data) % 4)
+
+
+def pack_blob(data):
+    """Pack a length-prefixed byte string, padded to 4 bytes."""
+    return struct.pack("<I", len(data)) + data + b'\x00' * (-len(data) % 4)
+
+
+def encode(view, full=False):
+    """
+    Encode a GraphView's next frame.
+
+    Like GraphView.build_graph, only sections which have changed since the
+    view was last sent are included, unless full is set.
+    """
+    nodes = view.node_data
+    flags = 0
+    body = []
+
+    if full or view.table != view.last_sent_table:
+        flags |= TABLE
+        strings = "\x00".join(s for n in nodes for s in (n["name"], n["ip"]))
+        body.append(pack_blob(strings.encode("utf-8")))
+        body.append(pack_array("I", [n["id"] for n in nodes]))
+
+    if full or view.nodes_changed():
+        flags |= LOADS
+        body.append(pack_array(
+            "H", [min(int(round(n["load"] * LOAD_SCALE)), 0xffff)
+                  for n in nodes]))
+
+    if full or view.links_changed():
+        flags |= LINKS
+        rows = view.rows
+        links = [l for l in view.link_data
+                 if l["source"] in rows and l["target"] in rows]
+        body.append(struct.pack("<I", len(links)))
+        body.append(pack_array("I", [rows[l["source"]] for l in links]))
+        body.append(pack_array("I", [rows[l["target"]] for l in links]))
+        body.append(pack_array("H", [l["value"] for l in links]))
+
+    if view.layout and (full or view.layout != view.last_sent_layout):
+        flags |= LAYOUT
+        xs = [NO_POSITION] * len(nodes)
+        ys = [NO_POSITION] * len(nodes)
+        for i, x, y in view.layout_data:
+            row = view.rows.get(i)
+            if row is not None:
+                xs[row] = int(round(x * (NO_POSITION - 1)))
+                ys[row] = int(round(y * (NO_POSITION - 1)))
+        body.append(pack_array("H", xs))
+        body.append(pack_array("H", ys))
+
+    if view.jobs:
+        flags |= JOBS
+        body.append(pack_blob(view.jobs.encode("utf-8")))
+
+    header = struct.pack(HEADER, VERSION, flags, 0, len(nodes))
+    return header + b''.join(body)
+
+
+class Decoder(object):
+    """
+    Decodes binary frames back into the same shape as JSON frames.
+
+    Keeps the most recent string table, so one Decoder must be used per
+    connection.  display.html contains the equivalent JavaScript decoder.
+    """
+
+    def __init__(self):
+        self.table = []
+
+    def _array(self, data, offset, typecode, count):
+        fmt = "<{0}{1}".format(count, typecode)
+        values = list(struct.unpack_from(fmt, data, offset))
+        size = struct.calcsize(fmt)
+        return values, offset + size + (-size % 4)
+
+    def _blob(self, data, offset):
+        (length,) = struct.unpack_from("<I", data, offset)
+        offset += 4
+        blob = data[offset:offset + length]
+        return blob, offset + length + (-length % 4)
+
+    def decode(self, data):
+        version, flags, _, count = struct.unpack_from(HEADER, data)
+        if version != VERSION:
+            raise ValueError("Unknown binary frame version {0}"
+                             .format(version))
+
+        offset = struct.calcsize(HEADER)
+        frame = {"timestamp": 0, "index": 0}
+
+        if flags & TABLE:
+            blob, offset = self._blob(data, offset)
+            strings = blob.decode("utf-8").split("\x00") if count else []
+            ids, offset = self._array(data, offset, "I", count)
+            self.table = [(ids[i], strings[2 * i], strings[2 * i + 1])
+                          for i in range(count)]
+
+        if flags & LOADS:
+            loads, offset = self._array(data, offset, "H", count)
+            frame["nodes"] = [{"id": i, "name": name, "ip": ip,
+                               "load": load / float(LOAD_SCALE)}
+                              for (i, name, ip), load
+                              in zip(self.table, loads)]
+
+        if flags & LINKS:
+            (n,) = struct.unpack_from("<I", data, offset)
+            offset += 4
+            sources, offset = self._array(data, offset, "I", n)
+            targets, offset = self._array(data, offset, "I", n)
+            values, offset = self._array(data, offset, "H", n)
+            frame["links"] = [{"source": self.table[s][0],
+                               "target": self.table[t][0],
+                               "value": v}
+                              for s, t, v in zip(sources, targets, values)]
+
+        if flags & LAYOUT:
+            xs, offset = self._array(data, offset, "H", count)
+            ys, offset = self._array(data, offset, "H", count)
+            frame["layout"] = [
+                [self.table[r][0],
+                 xs[r] / float(NO_POSITION - 1),
+                 ys[r] / float(NO_POSITION - 1)]
+                for r in range(count) if xs[r] != NO_POSITION]
+
+        if flags & JOBS:
+            blob, offset = self._blob(data, offset)
+            frame["jobs"] = json.loads(blob.decode("utf-8"))
+
+        return frame
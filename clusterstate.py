@@ -0,0 +1,247 @@
+"""Columnar view of the cluster state, for fast cluster-wide queries."""
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2.
+    from collections import MutableMapping
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class Columns(object):
+    """
+    A set of parallel NumPy arrays with one row per tracked object.
+
+    Rows are found by key through a key->row index.  Removing a row moves
+    the last row into its place, so the live rows are always 0 to len-1.
+    """
+
+    INITIAL_CAPACITY = 64
+
+    def __init__(self, **dtypes):
+        self.dtypes = dtypes
+        self.rows = {}
+        self.keys = []
+        self.capacity = self.INITIAL_CAPACITY
+        for name, dtype in dtypes.items():
+            setattr(self, name, numpy.zeros(self.capacity, dtype))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def column(self, name):
+        """The live part of a column."""
+        return getattr(self, name)[:len(self.keys)]
+
+    def add(self, key, **values):
+        """Add a row, or overwrite it if the key already has one."""
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row == self.capacity:
+                self._grow()
+            self.rows[key] = row
+            self.keys.append(key)
+
+        for name, value in values.items():
+            getattr(self, name)[row] = value
+
+    def remove(self, key):
+        """Remove a row if the key has one.  Returns whether it did."""
+        row = self.rows.pop(key, None)
+        if row is None:
+            return False
+
+        last = len(self.keys) - 1
+        if row != last:
+            moved = self.keys[last]
+            self.keys[row] = moved
+            self.rows[moved] = row
+        for name in self.dtypes:
+            column = getattr(self, name)
+            column[row] = column[last]
+            # Drop any reference held by an object column.
+            column[last] = 0
+        self.keys.pop()
+        return True
+
+    def _grow(self):
+        self.capacity *= 2
+        for name in self.dtypes:
+            column = getattr(self, name)
+            grown = numpy.zeros(self.capacity, column.dtype)
+            grown[:len(column)] = column
+            setattr(self, name, grown)
+
+
+class ClusterState(object):
+    """
+    Columnar CS and Job state for a Monitor.
+
+    CSs are kept in sync with the Monitor's CS objects by its message
+    handlers, so that cluster-wide numbers, and the nodes/links sent by
+    publishers, can be computed with vectorised operations rather than
+    loops over CS and Job objects.
+
+    Jobs are only stored here, with a column of references to their
+    filenames.  The Monitor reaches them through a JobTable.
+    """
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("ClusterState requires numpy")
+
+        self.cs = Columns(id=numpy.uint32, maxjobs=numpy.int32,
+                          active=numpy.int32)
+        # started is NaN until a job has been given a host.
+        self.jobs = Columns(id=numpy.uint32, client=numpy.uint32,
+                            host=numpy.uint32, local=numpy.bool_,
+                            created=numpy.float64, started=numpy.float64,
+                            filename=object)
+
+    # Updates, called by the Monitor.
+
+    def set_cs(self, host_id, maxjobs, active=0):
+        self.cs.add(host_id, id=host_id, maxjobs=maxjobs, active=active)
+
+    def remove_cs(self, host_id):
+        self.cs.remove(host_id)
+
+    def add_active(self, host_id, n):
+        """Change the number of active jobs on a CS by n."""
+        row = self.cs.rows.get(host_id)
+        if row is not None:
+            self.cs.active[row] += n
+
+    def add_job(self, job_id, client_id, host_id=0, local=False,
+                filename=b'', created=0.0, started=None):
+        """Add a job, or overwrite it if it already exists."""
+        self.jobs.add(job_id, id=job_id, client=client_id, host=host_id,
+                      local=local, filename=filename, created=created,
+                      started=numpy.nan if started is None else started)
+
+    def remove_job(self, job_id):
+        """Remove a job.  Returns whether it existed."""
+        return self.jobs.remove(job_id)
+
+    def job_fields(self, job_id):
+        """
+        Returns (client, host, local, filename, created, started) for a job.
+
+        Raises KeyError if there is no such job.
+        """
+        row = self.jobs.rows[job_id]
+        started = float(self.jobs.started[row])
+        return (int(self.jobs.client[row]), int(self.jobs.host[row]),
+                bool(self.jobs.local[row]), self.jobs.filename[row],
+                float(self.jobs.created[row]),
+                None if numpy.isnan(started) else started)
+
+    # Queries.
+
+    def total_capacity(self):
+        """Total job slots across all CSs."""
+        return int(self.cs.column("maxjobs").sum())
+
+    def total_active(self):
+        """Total jobs running across all CSs."""
+        return int(self.cs.column("active").sum())
+
+    def utilisation(self):
+        """Fraction of the cluster's job slots in use."""
+        capacity = self.total_capacity()
+        return self.total_active() / float(capacity) if capacity else 0.0
+
+    def loads(self):
+        """Returns arrays of CS ids and their load as a percentage."""
+        maxjobs = self.cs.column("maxjobs")
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            loads = 100.0 * self.cs.column("active") / maxjobs
+        return self.cs.column("id"), loads
+
+    def busiest(self, n):
+        """Returns a list of (host id, load percentage) for the n busiest CSs."""
+        ids, loads = self.loads()
+        if n < len(loads):
+            top = numpy.argpartition(-loads, n)[:n]
+        else:
+            top = numpy.arange(len(loads))
+        top = top[numpy.argsort(-loads[top], kind="mergesort")]
+        return list(zip(ids[top].tolist(), loads[top].tolist()))
+
+    def jobs_per_client(self):
+        """Returns a dict of client id -> number of jobs in progress."""
+        clients, counts = numpy.unique(self.jobs.column("client"),
+                                       return_counts=True)
+        return dict(zip(clients.tolist(), counts.tolist()))
+
+    def job_counts(self):
+        """Returns a dict of the number of jobs in progress, by kind."""
+        local = self.jobs.column("local")
+        pending = ~local & (self.jobs.column("host") == 0)
+        return {"total": len(self.jobs),
+                "local": int(local.sum()),
+                "remote": len(self.jobs) - int(local.sum()),
+                "pending": int(pending.sum())}
+
+    def links(self):
+        """
+        Returns arrays of (client, host) id pairs.
+
+        There is one pair for each client and CS where the client has one or
+        more jobs building on the CS, and both are known CSs.
+        """
+        client = self.jobs.column("client").astype(numpy.uint64)
+        host = self.jobs.column("host").astype(numpy.uint64)
+        ids = self.cs.column("id")
+        known = numpy.isin(client, ids) & numpy.isin(host, ids)
+
+        shift = numpy.uint64(32)
+        pairs = numpy.unique((client[known] << shift) | host[known])
+        return pairs >> shift, pairs & numpy.uint64(0xffffffff)
+
+
+class JobTable(MutableMapping):
+    """
+    Dict of job id -> Job, stored only in a ClusterState's columns.
+
+    A Job is built from the columns each time one is looked up, so changes
+    to it must be stored back with table[job.id] = job.  job_type is the
+    class of Job to build, which must take the same arguments as
+    monitor.Job.
+    """
+
+    def __init__(self, state, job_type):
+        self.state = state
+        self.job_type = job_type
+
+    def __getitem__(self, job_id):
+        (client, host, local, filename,
+         created, started) = self.state.job_fields(job_id)
+        job = self.job_type(job_id, filename, client, local)
+        job.host_id = host
+        job.created_at = created
+        job.started_at = started
+        return job
+
+    def __setitem__(self, job_id, job):
+        self.state.add_job(job_id, job.client_id, job.host_id, job.local,
+                           job.filename, job.created_at, job.started_at)
+
+    def __delitem__(self, job_id):
+        if not self.state.remove_job(job_id):
+            raise KeyError(job_id)
+
+    def __contains__(self, job_id):
+        return job_id in self.state.jobs
+
+    def __iter__(self):
+        return iter(list(self.state.jobs.keys))
+
+    def __len__(self):
+        return len(self.state.jobs)
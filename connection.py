@@ -76,12 +76,14 @@ class Connection(object):
         log.debug("Received:\n{0}".format(hex_print(s)))
         return s
 
-    def get_message(self):
-        """Receive the next full Message from the wire."""
+    def get_frame(self):
+        """Receive the bytes of the next full message from the wire."""
         length = struct.unpack("!L", self.receive(4))[0]
 
         log.debug("Receiving message of length {0}".format(length))
 
-        msg = self.receive(length)
+        return self.receive(length)
 
-        return messages.unpack(msg)
+    def get_message(self):
+        """Receive the next full Message from the wire."""
+        return messages.unpack(self.get_frame())
@@ -0,0 +1,138 @@
+"""Tracking of scheduler queue latency and placement efficiency."""
+import math
+import collections
+
+
+class Histogram(object):
+    """
+    Incremental histogram of durations with power-of-two buckets.
+
+    Bucket 0 counts durations under 1ms, bucket i durations from 2^(i-1) to
+    2^i ms.  Adding a value is O(1), and percentiles are estimated as the
+    upper bound of the bucket they fall in.
+    """
+
+    NUM_BUCKETS = 24
+    """Enough buckets for durations up to about 2 hours."""
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, seconds):
+        """Record one duration."""
+        ms = seconds * 1000
+        bucket = 0 if ms < 1 else math.frexp(ms)[1]
+        self.buckets[min(bucket, self.NUM_BUCKETS - 1)] += 1
+
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def percentile(self, p):
+        """Estimate the p'th percentile duration in seconds."""
+        if not self.count:
+            return None
+
+        target = p / 100.0 * self.count
+        seen = 0
+        for bucket, n in enumerate(self.buckets):
+            seen += n
+            if seen >= target and n:
+                return min((2 ** bucket) / 1000.0, self.max)
+        return self.max
+
+    def summary(self):
+        """Returns a dict describing the histogram."""
+        return {"count": self.count,
+                "mean": self.mean(),
+                "min": self.min,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99),
+                "buckets": list(self.buckets)}
+
+
+class SchedulerStats(object):
+    """
+    How long jobs wait for a CS, how long they run, and where they were put.
+
+    Wait time is from GetCS to JobBegin, the time a client waits for the
+    scheduler to find it a CS.  Run time is from JobBegin to JobDone.
+    Both are kept overall, per client and per host (the CS the job was
+    given).  Local jobs don't go through the scheduler, so aren't included.
+
+    A placement anomaly is a job sent to a CS which was already running
+    its maximum number of jobs.
+    """
+
+    MAX_ANOMALIES = 100
+    """Number of recent placement anomalies to remember."""
+
+    def __init__(self):
+        self.wait = Histogram()
+        self.run = Histogram()
+        self.client_wait = collections.defaultdict(Histogram)
+        self.client_run = collections.defaultdict(Histogram)
+        self.host_wait = collections.defaultdict(Histogram)
+        self.host_run = collections.defaultdict(Histogram)
+        self.placements = 0
+        self.anomaly_count = 0
+        self.anomalies = collections.deque(maxlen=self.MAX_ANOMALIES)
+
+    def record_wait(self, job, seconds):
+        self.wait.add(seconds)
+        self.client_wait[job.client_id].add(seconds)
+        self.host_wait[job.host_id].add(seconds)
+
+    def record_run(self, job, seconds):
+        self.run.add(seconds)
+        self.client_run[job.client_id].add(seconds)
+        self.host_run[job.host_id].add(seconds)
+
+    def record_placement(self, job, cs):
+        """Record a job being placed on a CS, before it is added to it."""
+        self.placements += 1
+        if cs.active_jobs() >= cs.maxjobs:
+            self.anomaly_count += 1
+            self.anomalies.append({"job": job.id,
+                                   "client": job.client_id,
+                                   "host": cs.id,
+                                   "active": cs.active_jobs(),
+                                   "maxjobs": cs.maxjobs})
+            return True
+        return False
+
+    def summary(self):
+        """
+        Returns a dict describing the stats, suitable for JSON.
+
+        May be called from another thread while the stats are being
+        updated.  Each dict is copied before it is walked, so it can't
+        change size underneath.
+        """
+        def by_id(histograms):
+            return dict((str(i), h.summary())
+                        for i, h in list(histograms.items()))
+
+        return {
+            "wait": self.wait.summary(),
+            "run": self.run.summary(),
+            "client_wait": by_id(self.client_wait),
+            "client_run": by_id(self.client_run),
+            "host_wait": by_id(self.host_wait),
+            "host_run": by_id(self.host_run),
+            "placements": self.placements,
+            "anomaly_count": self.anomaly_count,
+            "anomalies": list(self.anomalies),
+        }
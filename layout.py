@@ -0,0 +1,186 @@
+"""Server-side force-directed layout of the cluster graph."""
+import random
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ForceLayout(object):
+    """
+    Incremental force-directed (Fruchterman-Reingold) layout.
+
+    Node positions are kept in a NumPy array with one row per node, in the
+    unit square, so clients can scale them to whatever size they draw at.
+    Repulsion between every pair of nodes is computed with vectorised
+    operations a block of rows at a time, to bound memory on large clusters.
+
+    Each node has its own temperature, the furthest it may move in a step.
+    The layout is warm-started: when nodes or links change, existing nodes
+    keep their positions and only the new nodes, and the nodes at either
+    end of a new or removed link, are reheated.  The rest of the graph
+    stays where it is while those settle, rather than being recomputed.
+    """
+
+    BLOCK_SIZE = 256
+    """Rows of the pairwise repulsion computed at once."""
+
+    GRAVITY = 5.0
+    """Strength of the pull towards the centre, keeping components together."""
+
+    START_TEMPERATURE = 0.1
+    """Maximum distance a node may move in one step, for a fresh layout."""
+
+    WARM_TEMPERATURE = 0.02
+    """Maximum step of a node reheated by an incremental change."""
+
+    MIN_TEMPERATURE = 0.001
+    """Nodes stop moving once their step falls below this."""
+
+    COOLING = 0.95
+    """Factor by which the maximum step shrinks each iteration."""
+
+    def __init__(self):
+        if numpy is None:
+            raise ImportError("ForceLayout requires numpy")
+
+        self.ids = []
+        self.rows = {}
+        self.pos = numpy.zeros((0, 2))
+        self.edges = numpy.zeros((0, 2), dtype=numpy.intp)
+        self.temperature = numpy.zeros(0)
+
+    def update(self, node_ids, links):
+        """
+        Update the graph being laid out.
+
+        node_ids is an iterable of node ids, links an iterable of
+        (source, target) id pairs.  Links to unknown nodes are ignored.
+        """
+        node_ids = list(node_ids)
+        links = [(s, t) for s, t in links if s != t]
+        wanted = set(node_ids)
+
+        changed = len(wanted) != len(self.ids) or any(
+            i not in self.rows for i in node_ids)
+        old_links = set((self.ids[s], self.ids[t]) for s, t in self.edges)
+
+        if changed:
+            # Keep positions and temperatures of surviving nodes.
+            keep = [r for r, i in enumerate(self.ids) if i in wanted]
+            ids = [self.ids[r] for r in keep]
+            pos = self.pos[keep]
+            temperature = self.temperature[keep]
+
+            # Lay out from scratch if there was nothing to keep.
+            warm = self.WARM_TEMPERATURE if keep else self.START_TEMPERATURE
+            new = [i for i in node_ids if i not in self.rows]
+            new_pos = self._place_new(new, ids, pos, links)
+            self.ids = ids + new
+            self.rows = dict((i, r) for r, i in enumerate(self.ids))
+            self.pos = numpy.vstack([pos, new_pos])
+            self.temperature = numpy.concatenate(
+                [temperature, numpy.full(len(new), warm)])
+
+        links = set((s, t) for s, t in links
+                    if s in self.rows and t in self.rows)
+        self.edges = numpy.array(
+            sorted((self.rows[s], self.rows[t]) for s, t in links),
+            dtype=numpy.intp).reshape(-1, 2)
+
+        # Reheat the ends of links which were added or removed.
+        hot = [self.rows[i] for link in links ^ old_links for i in link
+               if i in self.rows]
+        if hot:
+            self.temperature[hot] = numpy.maximum(
+                self.temperature[hot], self.WARM_TEMPERATURE)
+
+    def _place_new(self, new, ids, pos, links):
+        """
+        Choose starting positions for new nodes.
+
+        A new node starts near the nodes it is linked to, if any of them
+        are already placed, otherwise near the centre.
+        """
+        placed = dict((i, r) for r, i in enumerate(ids))
+        neighbours = dict((i, []) for i in new)
+        for s, t in links:
+            if s in neighbours and t in placed:
+                neighbours[s].append(placed[t])
+            if t in neighbours and s in placed:
+                neighbours[t].append(placed[s])
+
+        new_pos = numpy.empty((len(new), 2))
+        for n, i in enumerate(new):
+            if neighbours[i]:
+                centre = pos[neighbours[i]].mean(axis=0)
+                spread = 0.02
+            else:
+                centre = (0.5, 0.5)
+                spread = 0.2
+            new_pos[n] = (centre[0] + random.uniform(-spread, spread),
+                          centre[1] + random.uniform(-spread, spread))
+
+        return new_pos
+
+    def converged(self):
+        """Has the layout settled?"""
+        return (len(self.ids) < 2 or
+                self.temperature.max() < self.MIN_TEMPERATURE)
+
+    def step(self, iterations=1):
+        """Run some iterations of the layout."""
+        n = len(self.ids)
+        if n < 2:
+            return
+
+        # Ideal distance between nodes.
+        k = 1.0 / numpy.sqrt(n)
+
+        for _ in range(iterations):
+            if self.converged():
+                return
+
+            pos = self.pos
+            x, y = pos[:, 0], pos[:, 1]
+            disp = numpy.zeros_like(pos)
+
+            # Repulsion between all pairs: k^2 / d along the separation.
+            for start in range(0, n, self.BLOCK_SIZE):
+                end = start + self.BLOCK_SIZE
+                dx = x[start:end, None] - x[None, :]
+                dy = y[start:end, None] - y[None, :]
+                scale = dx * dx
+                scale += dy * dy
+                numpy.maximum(scale, 1e-9, out=scale)
+                numpy.divide(k * k, scale, out=scale)
+                disp[start:end, 0] = numpy.einsum("ij,ij->i", dx, scale)
+                disp[start:end, 1] = numpy.einsum("ij,ij->i", dy, scale)
+
+            # Attraction along links: d^2 / k along the link.
+            if len(self.edges):
+                s, t = self.edges[:, 0], self.edges[:, 1]
+                delta = pos[s] - pos[t]
+                dist = numpy.sqrt((delta ** 2).sum(axis=1))[:, None]
+                force = delta * dist / k
+                numpy.add.at(disp, s, -force)
+                numpy.add.at(disp, t, force)
+
+            disp += self.GRAVITY * (0.5 - pos)
+
+            # Move each node at most its temperature in the direction of force.
+            length = numpy.sqrt((disp ** 2).sum(axis=1))[:, None]
+            length = numpy.maximum(length, 1e-9)
+            step = numpy.minimum(length, self.temperature[:, None])
+            pos += disp / length * step
+            numpy.clip(pos, 0.0, 1.0, out=pos)
+
+            # Nodes which have cooled down are frozen where they are.
+            self.temperature *= self.COOLING
+            self.temperature[self.temperature < self.MIN_TEMPERATURE] = 0.0
+
+    def positions(self):
+        """Returns a list of [id, x, y] for every node."""
+        rounded = numpy.round(self.pos, 4).tolist()
+        return [[i, x, y] for i, (x, y) in zip(self.ids, rounded)]
@@ -2,19 +2,31 @@
 from __future__ import print_function
 
 import sys
+import time
 import logging
+import threading
 
 import messages
+from clusterstate import ClusterState, JobTable
 from connection import Connection
+from latency import SchedulerStats
 from publishers import WebsocketPublisher
 
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
 
+# Clock for timing jobs, which mustn't jump if the system clock is changed.
+try:
+    monotonic = time.monotonic
+except AttributeError:  # Python 2.
+    monotonic = time.time
+
 
 class CS(object):
     """Represents one active compilation node."""
 
+    __slots__ = ("id", "name", "ip", "maxjobs", "_jobs")
+
     def __init__(self, id, name, ip, maxjobs):
         self.id = id
         self.name = name
@@ -30,7 +42,15 @@ class CS(object):
 
 
 class Job(object):
-    """Represents one active compile Job."""
+    """
+    Represents one active compile Job.
+
+    created_at and started_at are monotonic() times at which the job was
+    created and assigned to a host.
+    """
+
+    __slots__ = ("id", "filename", "client_id", "host_id", "local",
+                 "created_at", "started_at")
 
     def __init__(self, id, filename, client_id, local=False):
         self.id = id
@@ -38,6 +58,8 @@ class Job(object):
         self.client_id = client_id
         self.host_id = 0
         self.local = local
+        self.created_at = monotonic()
+        self.started_at = None
 
     def __str__(self):
         return (
@@ -55,14 +77,31 @@ class Monitor(object):
 
     Also may have one or more publishers attached which are notified
     whenever the state of the cluster changes.
+
+    If columnar is set, a ClusterState is also kept in sync with the CSs
+    for fast cluster-wide queries, and Jobs are stored only in its columns
+    rather than as Job objects, to save memory.  self.jobs is then a
+    JobTable, which builds Jobs when they are looked up, so a changed Job
+    must be stored back into it.  This requires numpy.
+
+    Scheduling latency and placement anomalies are tracked in self.latency.
+
+    self.lock is held while a message is applied to the state, so other
+    threads may hold it to read a consistent state.
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, columnar=False):
         self.conn = conn
         self.conn.send_message(messages.LoginMessage())
 
         self.cs = {}
         self.jobs = {}
+        self.state = None
+        if columnar:
+            self.state = ClusterState()
+            self.jobs = JobTable(self.state, Job)
+        self.latency = SchedulerStats()
+        self.lock = threading.Lock()
 
         self.publishers = []
 
@@ -70,30 +109,47 @@ class Monitor(object):
         """Add the publisher to the monitor."""
         self.publishers.append(p)
 
+    def publishJobEvent(self, kind, job, msg=None):
+        """
+        Tell publishers which stream job events that a job began or is done.
+
+        kind is "begin" or "done".  msg is the JobDoneMessage, if any.
+        """
+        for p in self.publishers:
+            if hasattr(p, "publish_job_event"):
+                p.publish_job_event(kind, job, msg)
+
     def run(self):
         """Main monitor loop.  Receives and handles messages one at a time."""
         while True:
-            msg = self.conn.get_message()
-
-            if isinstance(msg, messages.StatsMessage):
-                self.handleStats(msg)
-            elif isinstance(msg, messages.GetCSMessage):
-                self.handleGetCS(msg)
-            elif isinstance(msg, messages.JobBeginMessage):
-                self.handleJobBegin(msg)
-            elif isinstance(msg, messages.JobDoneMessage):
-                self.handleJobDone(msg)
-            elif isinstance(msg, messages.LocalJobBeginMessage):
-                self.handleLocalJobBegin(msg)
-            elif isinstance(msg, messages.LocalJobDoneMessage):
-                self.handleLocalJobDone(msg)
-            else:
-                print("Not handling message:")
-                print(msg)
-                print("")
-
-            for p in self.publishers:
-                p.publish(self)
+            self.handleMessage(self.conn.get_message())
+
+    def handleMessage(self, msg):
+        """Update the cluster state from one message, and publish it."""
+        with self.lock:
+            self.applyMessage(msg)
+
+        for p in self.publishers:
+            p.publish(self)
+
+    def applyMessage(self, msg):
+        """Update the cluster state from one message."""
+        if isinstance(msg, messages.StatsMessage):
+            self.handleStats(msg)
+        elif isinstance(msg, messages.GetCSMessage):
+            self.handleGetCS(msg)
+        elif isinstance(msg, messages.JobBeginMessage):
+            self.handleJobBegin(msg)
+        elif isinstance(msg, messages.JobDoneMessage):
+            self.handleJobDone(msg)
+        elif isinstance(msg, messages.LocalJobBeginMessage):
+            self.handleLocalJobBegin(msg)
+        elif isinstance(msg, messages.LocalJobDoneMessage):
+            self.handleLocalJobDone(msg)
+        else:
+            print("Not handling message:")
+            print(msg)
+            print("")
 
     def handleStats(self, msg):
         """
@@ -107,6 +163,8 @@ class Monitor(object):
                 log.info(
                     "({0}) went offline.".format(self.cs[msg.host_id]))
                 del self.cs[msg.host_id]
+                if self.state is not None:
+                    self.state.remove_cs(msg.host_id)
             return
 
         # Updating/Creating a CS.
@@ -119,6 +177,8 @@ class Monitor(object):
             log.info("New CS ({0}) came online.".format(cs))
 
         self.cs[msg.host_id] = cs
+        if self.state is not None:
+            self.state.set_cs(cs.id, cs.maxjobs, cs.active_jobs())
 
     def handleGetCS(self, msg):
         """
@@ -146,10 +206,20 @@ class Monitor(object):
 
         job = self.jobs[msg.job_id]
         job.host_id = msg.host_id
+        job.started_at = monotonic()
         log.info("Updated job: {0}".format(job))
+        self.latency.record_wait(job, job.started_at - job.created_at)
+        self.jobs[job.id] = job
 
         if job.host_id in self.cs:
+            if self.latency.record_placement(job, self.cs[job.host_id]):
+                log.info("Job {0} placed on full CS ({1})."
+                         .format(job.id, self.cs[job.host_id]))
             self.cs[job.host_id]._jobs.append(job.id)
+            if self.state is not None:
+                self.state.add_active(job.host_id, 1)
+
+        self.publishJobEvent("begin", job)
 
     def handleJobDone(self, msg):
         """
@@ -165,11 +235,17 @@ class Monitor(object):
         job = self.jobs[msg.job_id]
         log.info("Deleting job {0}.".format(job))
         del self.jobs[msg.job_id]
+        if job.started_at is not None:
+            self.latency.record_run(job, monotonic() - job.started_at)
 
         if job.host_id in self.cs:
             cs = self.cs[job.host_id]
             if job.id in cs._jobs:
                 cs._jobs.remove(job.id)
+                if self.state is not None:
+                    self.state.add_active(job.host_id, -1)
+
+        self.publishJobEvent("done", job, msg)
 
     def handleLocalJobBegin(self, msg):
         """
@@ -182,11 +258,16 @@ class Monitor(object):
         """
         job = Job(msg.job_id, msg.filename, msg.client_id, local=True)
         job.host_id = msg.client_id
+        job.started_at = job.created_at
         log.info("Created local job: {0}".format(job))
         self.jobs[job.id] = job
 
         if job.host_id in self.cs:
             self.cs[job.client_id]._jobs.append(job.id)
+            if self.state is not None:
+                self.state.add_active(job.host_id, 1)
+
+        self.publishJobEvent("begin", job)
 
     def handleLocalJobDone(self, msg):
         """
@@ -207,3 +288,7 @@ class Monitor(object):
             cs = self.cs[job.host_id]
             if job.id in cs._jobs:
                 cs._jobs.remove(job.id)
+                if self.state is not None:
+                    self.state.add_active(job.host_id, -1)
+
+        self.publishJobEvent("done", job)
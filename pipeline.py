@@ -0,0 +1,232 @@
+"""
+Run a Monitor as a pipeline of stages on separate threads and processes.
+
+Usage, instead of mon.run():
+
+    pipeline = Pipeline(mon)
+    pipeline.run() # Blocks forever.
+"""
+import time
+import struct
+import logging
+import threading
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import messages
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+def decode_frames(frames):
+    """Unpack a batch of frames into Messages.  Run in worker processes."""
+    return [messages.unpack(frame) for frame in frames]
+
+
+class StageMetrics(object):
+    """Throughput of one pipeline stage."""
+
+    def __init__(self):
+        self.count = 0
+        self.busy = 0.0
+
+    def record(self, seconds, count=1):
+        """Record count items taking seconds to process."""
+        self.count += count
+        self.busy += seconds
+
+    def summary(self, elapsed):
+        return {"count": self.count,
+                "rate": self.count / elapsed if elapsed else 0.0,
+                "busy": self.busy / elapsed if elapsed else 0.0}
+
+
+class _Stop(object):
+    """Passed down the pipeline when a stage fails."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class Pipeline(object):
+    """
+    Reads, decodes and applies messages for a Monitor in separate stages.
+
+    read:   Frames messages off the Monitor's Connection.
+    decode: Unpacks batches of frames into Messages.  If processes is set,
+            batches containing StatsMessages, which are the most expensive
+            to parse, are handed to a pool of that many worker processes.
+    apply:  Applies Messages to the Monitor and publishes.  This is the only
+            stage which touches Monitor state.
+
+    Worker processes are off by default.  Pickling frames and Messages to
+    and from a worker costs more than parsing a typical StatsMessage, so
+    they only help if the decode stage is the bottleneck with unusually
+    large Stats payloads.
+
+    Stages are connected by bounded queues, so a slow stage blocks the
+    stages before it rather than letting work pile up in memory.  Messages
+    are applied in the order they were read, even if decoded out of order.
+
+    Per-stage metrics show which stage is the bottleneck.  The busy
+    fraction of a stage is the proportion of time it spent processing rather
+    than waiting for work, though the read stage's busy time includes
+    waiting on the socket.  The queue in front of the bottleneck fills up.
+    """
+
+    QUEUE_SIZE = 1024
+    """Maximum items waiting between two stages."""
+
+    BATCH_SIZE = 64
+    """Maximum frames decoded together, and sent to a worker in one task."""
+
+    OFFLOAD_TYPES = (messages.StatsMessage.msg_type,)
+    """Message types whose batches are decoded in worker processes."""
+
+    METRICS_INTERVAL_S = 60
+    """Gap in seconds between logging pipeline metrics."""
+
+    def __init__(self, mon, processes=0, queue_size=None):
+        self.mon = mon
+        queue_size = queue_size or self.QUEUE_SIZE
+        self.frames = queue.Queue(queue_size)
+        self.decoded = queue.Queue(queue_size)
+        self.pool = multiprocessing.Pool(processes) if processes else None
+        self.stages = dict((name, StageMetrics())
+                           for name in ("read", "decode", "apply"))
+        self.start_time = None
+
+    def run(self):
+        """Start the read and decode stages, and run the apply stage."""
+        self.start_time = time.time()
+        for target in (self.read_stage, self.decode_stage):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+        try:
+            self.apply_stage()
+        finally:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool.join()
+
+    def _stage(self, name, get, process, output, count=lambda item: 1):
+        """
+        Main loop of a stage.
+
+        Takes items from get(), and puts process(item) onto output.
+        count(item) is the number of messages in an item, for metrics.
+        If anything fails, passes a _Stop on so the pipeline shuts down.
+        """
+        metrics = self.stages[name]
+        try:
+            while True:
+                item = get()
+                if isinstance(item, _Stop):
+                    output.put(item)
+                    return
+
+                start = time.time()
+                result = process(item)
+                metrics.record(time.time() - start, count(item))
+                output.put(result)
+        except Exception as e:
+            log.exception("Pipeline {0} stage failed.".format(name))
+            output.put(_Stop(e))
+
+    def read_stage(self):
+        self._stage("read", lambda: None,
+                    lambda _: self.mon.conn.get_frame(), self.frames)
+
+    def decode_stage(self):
+        self._stage("decode", self.get_batch, self.decode, self.decoded,
+                    count=len)
+
+    def get_batch(self):
+        """
+        Wait for a frame, then take up to BATCH_SIZE frames already queued.
+
+        Returns a list of frames, or a _Stop.
+        """
+        batch = [self.frames.get()]
+        while (len(batch) < self.BATCH_SIZE and
+               not isinstance(batch[-1], _Stop)):
+            try:
+                batch.append(self.frames.get_nowait())
+            except queue.Empty:
+                break
+
+        if isinstance(batch[-1], _Stop):
+            if len(batch) == 1:
+                return batch[0]
+            # Decode the frames before it first.  The read stage has exited,
+            # so there is room for it.
+            self.frames.put(batch.pop())
+        return batch
+
+    def decode(self, frames):
+        """
+        Decode a batch of frames, or start decoding it in a worker process.
+
+        Returns either a list of Messages, or an AsyncResult which will give
+        one.
+        """
+        if self.pool is not None and any(
+                struct.unpack("!L", frame[:4])[0] in self.OFFLOAD_TYPES
+                for frame in frames):
+            return self.pool.apply_async(decode_frames, (frames,))
+        return decode_frames(frames)
+
+    def apply_stage(self):
+        """Main loop of the apply stage.  Runs until a stage fails."""
+        metrics = self.stages["apply"]
+        next_log = time.time() + self.METRICS_INTERVAL_S
+
+        while True:
+            item = self.decoded.get()
+            if isinstance(item, _Stop):
+                raise item.error
+
+            if hasattr(item, "get"):
+                # Wait for a worker process to finish decoding.
+                item = item.get()
+
+            start = time.time()
+            for msg in item:
+                if msg is not None:
+                    self.mon.handleMessage(msg)
+            metrics.record(time.time() - start, len(item))
+
+            if start >= next_log:
+                log.info("Pipeline metrics: {0}".format(self.metrics()))
+                next_log = start + self.METRICS_INTERVAL_S
+
+    def bottleneck(self):
+        """
+        Name the stage currently limiting throughput.
+
+        That is the last stage with a queue more than half full in front of
+        it, since backpressure from it fills the queues before it too.  If
+        neither queue is, the pipeline is keeping up with the scheduler and
+        "read" is returned.
+        """
+        if self.decoded.qsize() > self.decoded.maxsize // 2:
+            return "apply"
+        if self.frames.qsize() > self.frames.maxsize // 2:
+            return "decode"
+        return "read"
+
+    def metrics(self):
+        """Returns a dict of throughput per stage and depth of each queue."""
+        elapsed = time.time() - self.start_time if self.start_time else 0.0
+        return {"stages": dict((name, m.summary(elapsed))
+                               for name, m in self.stages.items()),
+                "queues": {"frames": self.frames.qsize(),
+                           "decoded": self.decoded.qsize()},
+                "bottleneck": self.bottleneck()}
@@ -1,53 +1,589 @@
 import json
 import time
+import random
+import socket
+import struct
+import fnmatch
+import logging
 import threading
 from websocket_server import WebsocketServer
 
+# Handle difference in module names between python2/3.
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from socketserver import ThreadingMixIn
+
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+import binaryframe
+from latency import SchedulerStats
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+LOAD_DECIMALS = 2
+"""Decimal places loads are rounded to, as carried by binary frames."""
+
+
+def cluster_nodes(mon):
+    """Builds a list of dicts describing the CS nodes in the cluster."""
+    if getattr(mon, "state", None) is not None:
+        # Compute loads from the columnar state in one go.
+        ids, loads = mon.state.loads()
+        loads = loads.round(LOAD_DECIMALS)
+        return [{"id": i,
+                 "name": mon.cs[i].name,
+                 "ip": mon.cs[i].ip,
+                 "load": load}
+                for i, load in zip(ids.tolist(), loads.tolist())]
+
+    nodes = []
+
+    for cs in mon.cs.values():
+        nodes.append({"id": cs.id,
+                      "name": cs.name,
+                      "ip": cs.ip,
+                      "load": round(100.0 * cs.active_jobs() / cs.maxjobs,
+                                    LOAD_DECIMALS)})
+
+    return nodes
+
+
+def cluster_links(mon):
+    """
+    Builds a list of dicts describing the links in the cluster.
+
+    There is one link A->B if A has one or more jobs building on B.
+    """
+    if getattr(mon, "state", None) is not None:
+        sources, targets = mon.state.links()
+        return [{"source": s, "target": t, "value": 10}
+                for s, t in zip(sources.tolist(), targets.tolist())]
+
+    links = []
+    seen = set()
+    for job in mon.jobs.values():
+        if job.host_id not in mon.cs or job.client_id not in mon.cs:
+            continue
+
+        # Don't double-add links.
+        pair = (job.client_id, job.host_id)
+        if pair in seen:
+            continue
+        seen.add(pair)
+
+        links.append({"source": job.client_id,
+                      "target": job.host_id,
+                      "value": 10})
+
+    return links
+
+
+def job_counts(mon):
+    """
+    Builds a dict of the number of jobs in progress in the cluster.
+
+    pending jobs are remote jobs still waiting to be given a CS.
+    """
+    if getattr(mon, "state", None) is not None:
+        return mon.state.job_counts()
+
+    local = pending = 0
+    for job in mon.jobs.values():
+        if job.local:
+            local += 1
+        elif job.host_id == 0:
+            pending += 1
+
+    return {"total": len(mon.jobs),
+            "local": local,
+            "remote": len(mon.jobs) - local,
+            "pending": pending}
+
+
+def parse_network(network):
+    """
+    Parse an IPv4 address or CIDR range into a (base, mask) pair of ints.
+
+    Raises ValueError if the string isn't a valid address or range.
+    """
+    if "/" in network:
+        addr, bits = network.split("/", 1)
+        bits = int(bits)
+    else:
+        addr, bits = network, 32
+
+    if not 0 <= bits <= 32:
+        raise ValueError("Bad prefix length in {0}".format(network))
+
+    try:
+        (base,) = struct.unpack("!L", socket.inet_aton(addr))
+    except (socket.error, OSError):
+        raise ValueError("Bad IP address in {0}".format(network))
+
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    return base & mask, mask
+
+
+class Subscription(object):
+    """
+    A client's filter over the cluster graph.
+
+    A host is included if its name matches any of the name patterns (fnmatch
+    style), its IP lies in any of the networks, and its load is at least
+    min_load.  An empty list of patterns or networks matches every host.
+
+    If internal_links is set, only links between two included hosts are sent.
+    Otherwise any link touching an included host is sent, along with the
+    host at the other end so the link can be drawn.
+
+    If jobs is set, job start/finish events for jobs running on included
+    hosts are also sent.
+    """
+
+    def __init__(self, names=(), networks=(), min_load=0,
+                 internal_links=False, jobs=False):
+        self.names = tuple(sorted(set(names)))
+        self.networks = tuple(sorted(set(networks)))
+        self.min_load = min_load
+        self.internal_links = bool(internal_links)
+        self.jobs = bool(jobs)
+        self._ranges = [parse_network(n) for n in self.networks]
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        Build a Subscription from the object sent by a client.
+
+        Raises ValueError if the object is malformed.
+        """
+        if not isinstance(data, dict):
+            raise ValueError("Subscription must be an object")
+
+        names = data.get("names", [])
+        networks = data.get("networks", [])
+        if not isinstance(names, list) or not isinstance(networks, list):
+            raise ValueError("names and networks must be lists")
+
+        # bool is an int, but "min_load": true is a mistake, not 1%.
+        min_load = data.get("min_load", 0)
+        if isinstance(min_load, bool):
+            raise ValueError("min_load must be a number")
+        try:
+            min_load = float(min_load)
+        except (ValueError, TypeError):
+            raise ValueError("min_load must be a number")
+        if min_load != min_load:
+            raise ValueError("min_load must not be NaN")
+
+        return cls(names=[str(n) for n in names],
+                   networks=[str(n) for n in networks],
+                   min_load=min_load,
+                   internal_links=data.get("links") == "internal",
+                   jobs=bool(data.get("jobs", False)))
+
+    def key(self):
+        """Hashable key which is equal for identical subscriptions."""
+        return (self.names, self.networks, self.min_load, self.internal_links,
+                self.jobs)
+
+    def is_everything(self):
+        """True if this subscription doesn't filter any of the graph out."""
+        return (not self.names and not self.networks and
+                self.min_load <= 0 and not self.internal_links)
+
+    def matches_host(self, name, ip):
+        """Does a host match the name and network filters?"""
+        if self.names and not any(fnmatch.fnmatchcase(name, pattern)
+                                  for pattern in self.names):
+            return False
+
+        if self.networks:
+            try:
+                (addr,) = struct.unpack("!L", socket.inet_aton(ip))
+            except (socket.error, OSError):
+                return False
+            return any(addr & mask == base for base, mask in self._ranges)
+
+        return True
+
+
+JOB_DONE_FIELDS = ("rc", "real_ms", "user_ms", "sys_ms", "pfaults",
+                   "in_comp", "in_uncomp", "out_comp", "out_uncomp")
+"""Timing and size fields copied from a JobDoneMessage into a job event."""
+
+
+def job_event(kind, job, msg=None):
+    """Builds a dict describing a job starting or finishing."""
+    filename = job.filename
+    if isinstance(filename, bytes):
+        filename = filename.decode("utf-8", "replace")
+
+    event = {"event": kind,
+             "id": job.id,
+             "file": filename,
+             "client": job.client_id,
+             "host": job.host_id,
+             "local": job.local}
+
+    if msg is not None:
+        for field in JOB_DONE_FIELDS:
+            event[field] = getattr(msg, field)
+
+    return event
+
+
+class JobEventCounts(object):
+    """Number of jobs begun and done on one host during a tick."""
+
+    __slots__ = ("begun", "done")
+
+    def __init__(self):
+        self.begun = 0
+        self.done = 0
+
+
+class JobEventBuffer(object):
+    """
+    Collects job events for one view between frames.
+
+    Keeps at most max_events events per tick, chosen by reservoir sampling
+    so that adding an event is O(1) however many arrive, and every event is
+    equally likely to be sent.  Per-host counts of every event are kept so
+    clients still see the true rate when events have been sampled.
+    """
+
+    def __init__(self, max_events):
+        self.max_events = max_events
+        self.clear()
+
+    def clear(self):
+        self.seen = 0
+        self.sample = []
+        self.counts = {}
+
+    def add(self, kind, job, msg=None):
+        """Record a job event."""
+        counts = self.counts.get(job.host_id)
+        if counts is None:
+            counts = self.counts[job.host_id] = JobEventCounts()
+        if kind == "begin":
+            counts.begun += 1
+        else:
+            counts.done += 1
+
+        entry = (self.seen, kind, job, msg)
+        self.seen += 1
+        if len(self.sample) < self.max_events:
+            self.sample.append(entry)
+        else:
+            i = random.randrange(self.seen)
+            if i < self.max_events:
+                self.sample[i] = entry
+
+    def pending(self):
+        """Have any events arrived since the buffer was last drained?"""
+        return self.seen > 0
+
+    def drain(self):
+        """
+        Empty the buffer.
+
+        Returns the sampled events in arrival order, the per-host counts,
+        and whether any events were dropped by sampling.
+        """
+        self.sample.sort(key=lambda entry: entry[0])
+        events = [job_event(kind, job, msg)
+                  for _, kind, job, msg in self.sample]
+        counts, sampled = self.counts, self.seen > len(self.sample)
+        self.clear()
+        return events, counts, sampled
+
+
+class GraphView(object):
+    """
+    The part of the cluster graph visible through one Subscription.
+
+    Shared between all clients with an identical subscription, so each
+    frame is serialised once per view rather than once per client.  Nodes
+    and links are only serialised when a frame is built, so a view costs
+    one serialisation per frame sent, not one per Monitor message.
+
+    If the subscription asks for job events, the view buffers up to
+    max_job_events of them per frame for its own hosts (see JobEventBuffer).
+    """
+
+    def __init__(self, subscription, max_job_events=0):
+        self.subscription = subscription
+        self.job_events = None
+        if subscription.jobs:
+            self.job_events = JobEventBuffer(max_job_events)
+        self.clients = []
+        self.node_data = []
+        self.node_ids = set()
+        self.link_data = []
+        self.layout_data = []
+        self.table = []
+        self.rows = {}
+        # JSON of node_data and link_data, or None until next serialised.
+        self.nodes = None
+        self.links = None
+        self.jobs = ""
+        self.layout = ""
+        self.last_sent_node_data = None
+        self.last_sent_link_data = None
+        self.last_sent_layout = ""
+        self.last_sent_table = None
+        self._host_matches = {}
+
+    def _matches(self, node):
+        """Cached name/network match, recomputed only if the host changes."""
+        cached = self._host_matches.get(node["id"])
+        if (cached is not None and
+                cached[0] == node["name"] and cached[1] == node["ip"]):
+            return cached[2]
+
+        match = self.subscription.matches_host(node["name"], node["ip"])
+        self._host_matches[node["id"]] = (node["name"], node["ip"], match)
+        return match
+
+    def filter(self, nodes, links):
+        """Select the nodes and links from the cluster visible in this view."""
+        sub = self.subscription
+        if sub.is_everything():
+            return nodes, links
+
+        selected = [n for n in nodes
+                    if n["load"] >= sub.min_load and self._matches(n)]
+        ids = set(n["id"] for n in selected)
+
+        if sub.internal_links:
+            links = [l for l in links
+                     if l["source"] in ids and l["target"] in ids]
+        else:
+            links = [l for l in links
+                     if l["source"] in ids or l["target"] in ids]
+
+            # Pull in the far end of any link so the client can draw it.
+            extra = set()
+            for l in links:
+                extra.add(l["source"])
+                extra.add(l["target"])
+            extra -= ids
+            if extra:
+                selected += [n for n in nodes if n["id"] in extra]
+
+        return selected, links
+
+    def update(self, nodes, links):
+        """
+        Update the view from the full cluster nodes and links.
+
+        The data is only replaced if it has changed, so the view can tell
+        what has changed since it was last sent by identity.
+        """
+        nodes, links = self.filter(nodes, links)
+
+        if nodes != self.node_data:
+            self.node_data = nodes
+            self.node_ids = set(n["id"] for n in nodes)
+            self.nodes = None
+
+            # String table for binary frames, only changed if the set of
+            # nodes has.
+            table = [(n["id"], n["name"], n["ip"]) for n in nodes]
+            if table != self.table:
+                self.table = table
+                self.rows = dict((n[0], r) for r, n in enumerate(table))
+
+        if links != self.link_data:
+            self.link_data = links
+            self.links = None
+
+    def nodes_changed(self):
+        """Have the nodes changed since the view was last sent?"""
+        return self.node_data is not self.last_sent_node_data
+
+    def links_changed(self):
+        """Have the links changed since the view was last sent?"""
+        return self.link_data is not self.last_sent_link_data
+
+    def serialise(self):
+        """Serialise the nodes and links, if changed since last serialised."""
+        if self.nodes is None:
+            self.nodes = json.dumps(self.node_data)
+        if self.links is None:
+            self.links = json.dumps(self.link_data)
+
+    def update_layout(self, positions):
+        """Update the view from a list of [id, x, y] node positions."""
+        ids = self.node_ids
+        self.layout_data = [p for p in positions if p[0] in ids]
+        self.layout = json.dumps(self.layout_data)
+
+    def add_job_event(self, kind, job, msg=None):
+        """Buffer a job event, if the job is on one of the view's hosts."""
+        if self.job_events is not None and job.host_id in self.node_ids:
+            self.job_events.add(kind, job, msg)
+
+    def update_jobs(self):
+        """Set the job events buffered since the last frame to be sent."""
+        if self.job_events is None or not self.job_events.pending():
+            self.jobs = ""
+            return
+
+        events, counts, sampled = self.job_events.drain()
+        hosts = dict((host_id, [c.begun, c.done])
+                     for host_id, c in counts.items())
+
+        self.jobs = json.dumps({"events": events,
+                                "begun": sum(c.begun for c in counts.values()),
+                                "done": sum(c.done for c in counts.values()),
+                                "hosts": hosts,
+                                "sampled": sampled})
+
+    def build_graph(self, full=False):
+        """Builds a JSON representation of a graph of the view."""
+        self.serialise()
+        frame = '{"timestamp": 0, "index": 0'
+
+        if full or self.nodes_changed():
+            frame += ', "nodes": ' + self.nodes
+
+        if full or self.links_changed():
+            frame += ', "links": ' + self.links
+
+        if self.layout and (full or self.layout != self.last_sent_layout):
+            frame += ', "layout": ' + self.layout
+
+        if self.jobs:
+            frame += ', "jobs": ' + self.jobs
+
+        frame += '}'
+
+        return frame
+
+    def build_frame(self, encoding, full=False):
+        """Builds the next frame in the given encoding, "json" or "binary"."""
+        if encoding == "binary":
+            return binaryframe.encode(self, full)
+        return self.build_graph(full)
+
+    def changed(self):
+        """Has the view changed since it was last sent?"""
+        return (self.nodes_changed() or
+                self.links_changed() or
+                self.layout != self.last_sent_layout or
+                bool(self.jobs) or
+                (self.job_events is not None and self.job_events.pending()))
+
+    def mark_sent(self):
+        self.last_sent_node_data = self.node_data
+        self.last_sent_link_data = self.link_data
+        self.last_sent_layout = self.layout
+        self.last_sent_table = self.table
+        self.jobs = ""
+
 
 class WebsocketPublisher(object):
     """
     Publish cluster state as JSON over a websocket.
 
-    Only sends CS state, and information on who is building on who.
-    This is enough information to draw a graph of the cluster.
-    Explicitly, does not send information on individual jobs.
+    By default only sends CS state, and information on who is building on
+    who.  This is enough information to draw a graph of the cluster.
+
+    Clients may send a subscription to receive only part of the cluster:
+
+        {"subscribe": {"names": ["build-*"], "networks": ["10.1.0.0/16"],
+                       "min_load": 10, "links": "internal"}}
+
+    Adding "jobs": true to a subscription also streams job start/finish
+    events on the view's hosts, batched into one frame per tick:
+
+        {"jobs": {"events": [...], "begun": 12, "done": 10,
+                  "hosts": {"3": [12, 10]}, "sampled": false}}
+
+    Events may be sampled when many arrive in one tick, but the begun and
+    done counts, in total and per host id, cover every event.
+
+    Clients with identical subscriptions share one GraphView.
+
+    If given a layout (see layout.ForceLayout) the graph is laid out on a
+    background thread, and node positions are sent to clients in the unit
+    square so that browsers only need to draw the graph.
+
+    Clients may ask for compact binary frames (see binaryframe) instead of
+    JSON by sending {"encoding": "binary"}.
     """
 
     MIN_SEND_GAP_S = 0.1
     """Minimum gap in seconds between sending messages to connected clients."""
 
-    def __init__(self, host="0.0.0.0", port=9999):
-        self.frame = ""
-        self.nodes = ""
-        self.links = ""
-        self.last_sent_frame = ""
-        self.last_sent_nodes = ""
-        self.last_sent_links = ""
+    MAX_JOB_EVENTS_PER_FRAME = 100
+    """Job events beyond this many per frame are sampled and summarised."""
+
+    LAYOUT_INTERVAL_S = 0.1
+    """Gap in seconds between steps of the server-side layout."""
+
+    ENCODINGS = ("json", "binary")
+    """Frame encodings a client may ask for."""
+
+    def __init__(self, host="0.0.0.0", port=9999, layout=None):
+        self.layout = layout
+        self.layout_graph = None
+        self.layout_last_graph = None
+        self.layout_positions = None
+        self.cluster_nodes = []
+        self.cluster_links = []
+        self.default_view = GraphView(Subscription())
+        self.views = {self.default_view.subscription.key(): self.default_view}
+        self.client_views = {}
+        self.client_encodings = {}
+        self.job_views = []
         self.next_time_to_send = 0
         self.lock = threading.RLock()
         self.timer = None
-        self.ws_server = WebsocketServer(port, host)
+        self.ws_server = WebsocketServer(host=host, port=port)
+
+        def new_client(client, server):
+            with self.lock:
+                self.set_client_view(client, self.default_view)
 
-        def send_to_client(client, server):
+        def client_left(client, server):
+            if client is None:
+                return
             with self.lock:
-                server.send_message(client, self.build_graph(True))
+                self.remove_client(client)
+                self.client_encodings.pop(client["id"], None)
 
-        self.ws_server.set_fn_new_client(send_to_client)
+        def message_received(client, server, message):
+            self.handle_client_message(client, message)
+
+        self.ws_server.set_fn_new_client(new_client)
+        self.ws_server.set_fn_client_left(client_left)
+        self.ws_server.set_fn_message_received(message_received)
         t = threading.Thread(target=self.ws_server.run_forever)
         t.daemon = True
         t.start()
 
+        if self.layout is not None:
+            t = threading.Thread(target=self.run_layout)
+            t.daemon = True
+            t.start()
+
     def build_nodes(self, mon):
         """Builds a JSON representation of the CS nodes in the cluster."""
-        nodes = []
-
-        for cs in mon.cs.values():
-            nodes.append({"id": cs.id,
-                          "name": cs.name,
-                          "ip": cs.ip,
-                          "load": (100*cs.active_jobs())/cs.maxjobs})
-
-        return json.dumps(nodes)
+        return json.dumps(cluster_nodes(mon))
 
     def build_links(self, mon):
         """
@@ -55,36 +591,137 @@ class WebsocketPublisher(object):
 
         There is one link A->B if A has one or more jobs building on B.
         """
-        links = []
-        for job in mon.jobs.values():
-            if job.host_id not in mon.cs or job.client_id not in mon.cs:
-                continue
-            c, s = mon.cs[job.client_id], mon.cs[job.host_id]
+        return json.dumps(cluster_links(mon))
 
-            # Don't double-add links.
-            add = True
-            for l in links:
-                if l["source"] == c.id and l["target"] == s.id:
-                    add = False
+    def build_graph(self, full=False):
+        """Builds a full JSON representation of a graph of the cluster."""
+        return self.default_view.build_graph(full)
 
-            if add:
-                links.append({"source": c.id, "target": s.id, "value": 10})
+    def get_view(self, subscription):
+        """Find or create the view shared by clients with this subscription."""
+        key = subscription.key()
+        if key not in self.views:
+            view = GraphView(subscription, self.MAX_JOB_EVENTS_PER_FRAME)
+            view.update(self.cluster_nodes, self.cluster_links)
+            if self.layout_positions is not None:
+                view.update_layout(self.layout_positions)
+            # The client joining the view is about to be sent it in full.
+            view.mark_sent()
+            self.views[key] = view
+            if subscription.jobs:
+                self.job_views.append(view)
+        return self.views[key]
 
-        return json.dumps(links)
+    def set_client_view(self, client, view):
+        """Move a client onto a view and send it that view in full."""
+        if self.client_views.get(client["id"]) is not view:
+            self.remove_client(client)
+            view.clients.append(client)
+            self.client_views[client["id"]] = view
+        self.send_frame(client, view.build_frame(self.encoding(client), True))
 
-    def build_graph(self, full=False):
-        """Builds a full JSON representation of a graph of the cluster."""
-        frame = '{"timestamp": 0, "index": 0'
+    def encoding(self, client):
+        """The frame encoding a client has asked for."""
+        return self.client_encodings.get(client["id"], "json")
 
-        if full or self.nodes != self.last_sent_nodes:
-            frame += ', "nodes": ' + self.nodes
+    def send_frame(self, client, frame):
+        """Send a frame built by GraphView.build_frame to a client."""
+        if isinstance(frame, bytes):
+            self.send_binary(client, frame)
+        else:
+            self.ws_server.send_message(client, frame)
 
-        if full or self.links != self.last_sent_links:
-            frame += ', "links": ' + self.links
+    def send_binary(self, client, data):
+        """
+        Send data to a client as a binary websocket message.
 
-        frame += '}'
+        websocket_server only sends text messages, so build the frame here.
+        """
+        header = bytearray([0x82])  # FIN, binary opcode.
+        if len(data) <= 125:
+            header.append(len(data))
+        elif len(data) <= 0xffff:
+            header.append(126)
+            header += struct.pack("!H", len(data))
+        else:
+            header.append(127)
+            header += struct.pack("!Q", len(data))
 
-        return frame
+        # Writes to the handler's socket under the lock websocket_server
+        # uses for its own sends, so frames are never interleaved.
+        handler = client["handler"]
+        send_lock = getattr(handler, "_send_lock", None)
+        if send_lock is None:
+            # Checked when the encoding is negotiated, so this is not
+            # expected; never raise from the broadcast.
+            log.warning("Cannot send binary frame to client {0}: no send lock"
+                        .format(client["id"]))
+            return
+        try:
+            with send_lock:
+                handler.request.sendall(bytes(header) + data)
+        except (socket.error, OSError) as e:
+            log.warning("Failed to send to client {0}: {1}"
+                        .format(client["id"], e))
+
+    def remove_client(self, client):
+        """Detach a client from its view, dropping the view if now unused."""
+        view = self.client_views.pop(client["id"], None)
+        if view is None:
+            return
+
+        view.clients = [c for c in view.clients if c["id"] != client["id"]]
+        if not view.clients and view is not self.default_view:
+            del self.views[view.subscription.key()]
+            if view in self.job_views:
+                self.job_views.remove(view)
+
+    def supports_binary(self, client):
+        """
+        Whether binary frames can be sent to a client.
+
+        They are written straight to the handler's socket, so need the
+        _send_lock that websocket-server 0.6.4 and later give each handler.
+        """
+        handler = client.get("handler")
+        return handler is None or hasattr(handler, "_send_lock")
+
+    def handle_client_message(self, client, message):
+        """Handle a message sent to us by a client."""
+        try:
+            data = json.loads(message)
+            if not isinstance(data, dict):
+                raise ValueError("Message must be an object")
+
+            encoding = data.get("encoding")
+            if encoding is not None and encoding not in self.ENCODINGS:
+                raise ValueError("Unknown encoding {0}".format(encoding))
+
+            subscription = None
+            if "subscribe" in data:
+                subscription = Subscription.from_json(data["subscribe"])
+        except (ValueError, TypeError) as e:
+            log.warning("Ignoring bad message from client {0}: {1}"
+                        .format(client["id"], e))
+            return
+
+        if encoding == "binary" and not self.supports_binary(client):
+            log.warning("Client {0} asked for binary frames, which need a "
+                        "websocket-server whose handlers have a _send_lock, "
+                        "such as 0.6.4; sending JSON".format(client["id"]))
+            encoding = "json"
+
+        with self.lock:
+            if encoding is not None:
+                self.client_encodings[client["id"]] = encoding
+
+            if subscription is not None:
+                view = self.get_view(subscription)
+            else:
+                view = self.client_views.get(client["id"], self.default_view)
+
+            # Resend the whole view, in case the encoding has changed.
+            self.set_client_view(client, view)
 
     def publish(self, mon):
         """
@@ -93,17 +730,76 @@ class WebsocketPublisher(object):
         Update our internal state, and notify clients if appropriate.
         """
         with self.lock:
-            self.nodes = self.build_nodes(mon)
-            self.links = self.build_links(mon)
-            self.frame = self.build_graph()
+            self.cluster_nodes = cluster_nodes(mon)
+            self.cluster_links = cluster_links(mon)
+            for view in self.views.values():
+                view.update(self.cluster_nodes, self.cluster_links)
+            if self.layout is not None:
+                self.update_layout_graph()
             self.notify()
 
+    def update_layout_graph(self):
+        """
+        Hand the graph to the layout thread if its shape has changed.
+
+        Most messages only change loads, so the layout is left to converge
+        and stop rather than being given the same graph again.
+        """
+        # Local jobs link a host to itself, which the layout ignores.
+        graph = ([n["id"] for n in self.cluster_nodes],
+                 set((l["source"], l["target"]) for l in self.cluster_links
+                     if l["source"] != l["target"]))
+        if graph != self.layout_last_graph:
+            # Picked up by the layout thread on its next step.
+            self.layout_graph = self.layout_last_graph = graph
+
+    def run_layout(self):
+        """Main loop of the layout thread."""
+        while True:
+            time.sleep(self.LAYOUT_INTERVAL_S)
+            self.step_layout()
+
+    def step_layout(self):
+        """
+        Run one step of the layout and send any new positions to clients.
+
+        The layout itself runs outside the lock so it never holds up the
+        Monitor.
+        """
+        with self.lock:
+            graph, self.layout_graph = self.layout_graph, None
+
+        if graph is not None:
+            self.layout.update(*graph)
+        elif self.layout.converged():
+            return
+
+        self.layout.step()
+        positions = self.layout.positions()
+
+        with self.lock:
+            self.layout_positions = positions
+            for view in self.views.values():
+                view.update_layout(positions)
+            self.notify()
+
+    def publish_job_event(self, kind, job, msg=None):
+        """
+        Called by the Monitor when a job begins or is done.
+
+        Events are only buffered by views whose clients have asked for
+        them, each for its own hosts, and are sent with the next frame.
+        """
+        with self.lock:
+            for view in self.job_views:
+                view.add_job_event(kind, job, msg)
+
     def notify(self):
         """Send updates to clients if necessary."""
         now = time.time()
         with self.lock:
-            if self.frame == self.last_sent_frame:
-                # Frame hasn't changed, don't resend.
+            if not any(view.changed() for view in self.views.values()):
+                # No frame has changed, don't resend.
                 return
             elif (now >= self.next_time_to_send and self.timer is None):
                 # We can send.
@@ -121,7 +817,225 @@ class WebsocketPublisher(object):
                 self.timer.cancel()
             self.timer = None
             self.next_time_to_send = time.time() + self.MIN_SEND_GAP_S
-            self.last_sent_frame = self.frame
-            self.last_sent_nodes = self.nodes
-            self.last_sent_links = self.links
-            self.ws_server.send_message_to_all(self.frame)
+
+            for view in self.job_views:
+                view.update_jobs()
+
+            for view in self.views.values():
+                if not view.changed():
+                    continue
+
+                # Build each encoding at most once per view.
+                frames = {}
+                for client in view.clients:
+                    encoding = self.encoding(client)
+                    if encoding not in frames:
+                        frames[encoding] = view.build_frame(encoding)
+                    self.send_frame(client, frames[encoding])
+                view.mark_sent()
+
+
+class SnapshotRequestHandler(BaseHTTPRequestHandler):
+    """Serves the snapshot of a SnapshotPublisher (self.server.publisher)."""
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/latency":
+            self.send_json(self.server.publisher.latency())
+            return
+        if url.path not in ("/", "/snapshot"):
+            self.send_error(404)
+            return
+
+        publisher = self.server.publisher
+        try:
+            wait = parse_qs(url.query).get("wait")
+            wait = publisher.parse_version(wait[0]) if wait else None
+        except ValueError:
+            self.send_error(400, "wait must be a snapshot version")
+            return
+
+        version, body = publisher.snapshot(wait)
+        etag = '"{0}"'.format(version)
+        if_none_match = self.headers.get("If-None-Match", "")
+        if etag in [t.strip() for t in if_none_match.split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_json(body, etag)
+
+    def send_json(self, body, etag=None):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug("Snapshot request from {0}: {1}"
+                  .format(self.client_address[0], format % args))
+
+
+class SnapshotHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class SnapshotPublisher(object):
+    """
+    Publish cluster state as a JSON snapshot over HTTP.
+
+    GET /snapshot returns the current nodes, links and job counts, along
+    with the version of the state, "<epoch>-<n>".  The epoch is the time
+    the publisher started, so versions from before a restart never match,
+    and n increases every time the state changes.  The version is also
+    sent as the ETag, so a client sending it back in If-None-Match gets a
+    304 if nothing has changed.
+
+    GET /snapshot?wait=<version> long-polls: it waits until there is a
+    newer version, or MAX_WAIT_S has passed.  A version from before a
+    restart returns the current snapshot straight away.
+
+    The Monitor only marks the snapshot as stale.  It is rebuilt by the
+    next request, at most every MIN_REBUILD_GAP_S however many clients are
+    polling, and serialised once per version, so polling clients cost the
+    monitor very little.  A snapshot may therefore be up to
+    MIN_REBUILD_GAP_S old.
+
+    GET /latency returns the Monitor's scheduling latency histograms and
+    placement anomalies (see latency.SchedulerStats).
+    """
+
+    MAX_WAIT_S = 30
+    """Longest time in seconds a long-poll request waits for a new version."""
+
+    MIN_REBUILD_GAP_S = 0.1
+    """Minimum gap in seconds between rebuilds of the snapshot."""
+
+    def __init__(self, host="0.0.0.0", port=9998):
+        self.epoch = str(int(time.time() * 1000))
+        self.version = 0
+        self.state = ([], [], {"total": 0, "local": 0,
+                               "remote": 0, "pending": 0})
+        self.mon = None
+        # Number of times the Monitor has published, and how many of those
+        # the state was last built after.
+        self.published = 0
+        self.built = 0
+        self.built_at = 0
+        self.cond = threading.Condition()
+        self.build_lock = threading.Lock()
+        self.body = None
+        self.body_version = None
+        self.body_lock = threading.Lock()
+        self.http_server = SnapshotHTTPServer((host, port),
+                                              SnapshotRequestHandler)
+        self.http_server.publisher = self
+
+        t = threading.Thread(target=self.http_server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def publish(self, mon):
+        """
+        Called by the Monitor to indicate new cluster state.
+
+        Marks the snapshot as stale, and wakes up any long-polling requests
+        to rebuild it.
+        """
+        with self.cond:
+            self.mon = mon
+            self.published += 1
+            self.cond.notify_all()
+
+    def parse_version(self, version):
+        """
+        Parse a version string sent by a client.
+
+        Returns its number if it is from this publisher, otherwise None.
+        Raises ValueError if it isn't a version.
+        """
+        epoch, _, n = version.rpartition("-")
+        n = int(n)
+        if not epoch:
+            raise ValueError("Bad version {0}".format(version))
+        return n if epoch == self.epoch else None
+
+    def stale(self):
+        """Has the Monitor published since the state was last built?"""
+        return self.published != self.built
+
+    def refresh(self):
+        """
+        Rebuild the state if it is stale and wasn't rebuilt within the last
+        MIN_REBUILD_GAP_S.  Bumps the version if the state has changed.
+
+        The state is read under the Monitor's lock, so it is never seen
+        part way through a message.
+        """
+        with self.build_lock:
+            with self.cond:
+                if (not self.stale() or
+                        time.time() < self.built_at + self.MIN_REBUILD_GAP_S):
+                    return
+                published, mon = self.published, self.mon
+
+            with mon.lock:
+                state = (cluster_nodes(mon), cluster_links(mon),
+                         job_counts(mon))
+
+            with self.cond:
+                self.built = published
+                self.built_at = time.time()
+                if state != self.state:
+                    self.state = state
+                    self.version += 1
+
+    def snapshot(self, wait=None):
+        """
+        Returns the current version string and its serialised snapshot.
+
+        If wait is given, first waits up to MAX_WAIT_S for the version
+        number to become greater than it.
+        """
+        deadline = time.time() + self.MAX_WAIT_S
+        while True:
+            self.refresh()
+            with self.cond:
+                remaining = deadline - time.time()
+                if wait is None or self.version > wait or remaining <= 0:
+                    version, (nodes, links, jobs) = self.version, self.state
+                    break
+                if not self.stale():
+                    # Wait for the Monitor to publish.
+                    self.cond.wait(remaining)
+                    continue
+
+            # Stale, but rebuilt too recently.  Wait until it may be rebuilt.
+            time.sleep(max(0, min(remaining, self.built_at +
+                                  self.MIN_REBUILD_GAP_S - time.time())))
+
+        # Serialise outside the condition so the Monitor is never held up,
+        # but only once per version.
+        version = "{0}-{1}".format(self.epoch, version)
+        with self.body_lock:
+            if self.body_version != version:
+                self.body = json.dumps({"version": version,
+                                        "nodes": nodes,
+                                        "links": links,
+                                        "jobs": jobs}).encode("utf-8")
+                self.body_version = version
+            return version, self.body
+
+    def latency(self):
+        """Returns the Monitor's serialised scheduling latency stats."""
+        mon = self.mon
+        if mon is None:
+            return json.dumps(SchedulerStats().summary()).encode("utf-8")
+        with mon.lock:
+            summary = mon.latency.summary()
+        return json.dumps(summary).encode("utf-8")
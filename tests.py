@@ -1,7 +1,27 @@
+import sys
+import json
+import time
+import struct
 import unittest
+import threading
+
+try:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
 
 import messages
+import layout
+import binaryframe
+import clusterstate
+import monitor
+from latency import Histogram
+from pipeline import Pipeline
 from monitor import Monitor
+from publishers import (Subscription, GraphView, WebsocketPublisher,
+                        JobEventBuffer, SnapshotPublisher, cluster_nodes,
+                        cluster_links)
 
 
 class DummyConnection(object):
@@ -74,5 +94,706 @@ class TestMonitor(unittest.TestCase):
         self.assertEqual(m.cs[101].active_jobs(), 0)
 
 
+def add_cs(mon, host_id, name, ip, maxjobs=4):
+    """Bring a CS online in the monitor."""
+    stats = messages.StatsMessage(host_id, b'')
+    stats.data["Name"] = name
+    stats.data["IP"] = ip
+    stats.data["MaxJobs"] = str(maxjobs)
+    mon.handleStats(stats)
+
+
+class RecordingPublisher(WebsocketPublisher):
+    """WebsocketPublisher which records messages instead of sending them."""
+
+    MIN_SEND_GAP_S = 0
+
+    def __init__(self, layout=None):
+        WebsocketPublisher.__init__(self, host="127.0.0.1", port=0,
+                                    layout=layout)
+        self.sent = []
+        self.ws_server.send_message = (
+            lambda client, msg: self.sent.append((client["id"], msg)))
+
+    def send_binary(self, client, data):
+        self.sent.append((client["id"], data))
+
+    def run_layout(self):
+        """Layout is stepped explicitly by tests."""
+        pass
+
+
+class TestSubscriptions(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = Monitor(DummyConnection())
+        add_cs(self.mon, 1, "build-1", "10.1.0.1")
+        add_cs(self.mon, 2, "build-2", "10.1.0.2")
+        add_cs(self.mon, 3, "desk-1", "10.2.0.1")
+        self.mon.handleLocalJobBegin(
+            messages.LocalJobBeginMessage(100, 1, 0, b'a.c'))
+        self.mon.handleGetCS(messages.GetCSMessage(b'b.c', 0, 101, 3))
+        self.mon.handleJobBegin(messages.JobBeginMessage(101, 0, 2))
+
+    def view_of(self, **kwargs):
+        view = GraphView(Subscription(**kwargs))
+        view.update(cluster_nodes(self.mon), cluster_links(self.mon))
+        return view
+
+    def test_bad_network(self):
+        self.assertRaises(ValueError, Subscription, networks=["10.0.0.0/33"])
+        self.assertRaises(ValueError, Subscription, networks=["not.an.ip"])
+
+    def test_names_and_networks(self):
+        sub = Subscription(names=["build-*"], networks=["10.1.0.0/16"])
+        self.assertTrue(sub.matches_host("build-1", "10.1.3.4"))
+        self.assertFalse(sub.matches_host("build-1", "10.2.3.4"))
+        self.assertFalse(sub.matches_host("desk-1", "10.1.3.4"))
+
+    def test_min_load(self):
+        view = self.view_of(min_load=25, internal_links=True)
+        self.assertEqual(sorted(n["id"] for n in view.node_data), [1, 2])
+
+    def test_min_load_from_json(self):
+        sub = Subscription.from_json({"min_load": 12.5})
+        self.assertEqual(sub.min_load, 12.5)
+        for bad in (True, "lots", None, [10], float("nan")):
+            self.assertRaises(ValueError, Subscription.from_json,
+                              {"min_load": bad})
+
+    def test_links_pull_in_far_end(self):
+        view = self.view_of(names=["build-2"])
+        self.assertEqual(sorted(n["id"] for n in view.node_data), [2, 3])
+        self.assertEqual(len(view.link_data), 1)
+
+    def test_internal_links(self):
+        view = self.view_of(names=["build-2"], internal_links=True)
+        self.assertEqual([n["id"] for n in view.node_data], [2])
+        self.assertEqual(view.link_data, [])
+
+    def test_serialised_per_frame(self):
+        view = self.view_of()
+        self.assertIsNone(view.nodes)
+        view.build_graph()
+        nodes = view.nodes
+
+        # Publishing unchanged state doesn't reserialise, or count as changed.
+        view.mark_sent()
+        view.update(cluster_nodes(self.mon), cluster_links(self.mon))
+        self.assertIs(view.nodes, nodes)
+        self.assertFalse(view.changed())
+
+        # Changes are only serialised when the next frame is built.
+        self.mon.handleLocalJobDone(messages.LocalJobDoneMessage(100))
+        view.update(cluster_nodes(self.mon), cluster_links(self.mon))
+        self.assertIsNone(view.nodes)
+        self.assertTrue(view.changed())
+        self.assertIn('"nodes"', view.build_graph())
+
+    def test_shared_views(self):
+        pub = RecordingPublisher()
+        pub.publish(self.mon)
+        clients = [{"id": i} for i in range(3)]
+        sub = json.dumps({"subscribe": {"names": ["desk-*"]}})
+        for c in clients:
+            pub.ws_server.new_client(c, pub.ws_server)
+        pub.handle_client_message(clients[0], sub)
+        pub.handle_client_message(clients[1], sub)
+
+        self.assertEqual(len(pub.views), 2)
+        self.assertIs(pub.client_views[0], pub.client_views[1])
+        self.assertIs(pub.client_views[2], pub.default_view)
+
+        # Each client receives its own view in full on joining it.
+        frame = json.loads(pub.sent[-1][1])
+        self.assertEqual(sorted(n["name"] for n in frame["nodes"]),
+                         ["build-2", "desk-1"])
+
+        pub.ws_server.client_left(clients[0], pub.ws_server)
+        pub.ws_server.client_left(clients[1], pub.ws_server)
+        self.assertEqual(list(pub.views.values()), [pub.default_view])
+
+
+class TestJobEvents(unittest.TestCase):
+
+    def test_sampling(self):
+        """Test that a storm of events is sampled but fully counted."""
+        buf = JobEventBuffer(10)
+        mon = Monitor(DummyConnection())
+        for i in range(1000):
+            mon.handleLocalJobBegin(
+                messages.LocalJobBeginMessage(i, 1 + i % 2, 0, b'a.c'))
+            buf.add("begin", mon.jobs[i])
+
+        events, counts, sampled = buf.drain()
+        self.assertEqual(len(events), 10)
+        self.assertTrue(sampled)
+        self.assertEqual(counts[1].begun + counts[2].begun, 1000)
+        ids = [e["id"] for e in events]
+        self.assertEqual(ids, sorted(ids))
+        self.assertFalse(buf.pending())
+
+    def test_opt_in(self):
+        mon = Monitor(DummyConnection())
+        pub = RecordingPublisher()
+        mon.addPublisher(pub)
+        add_cs(mon, 1, "build-1", "10.1.0.1")
+        pub.publish(mon)
+
+        watcher, other = {"id": 1}, {"id": 2}
+        pub.ws_server.new_client(watcher, pub.ws_server)
+        pub.ws_server.new_client(other, pub.ws_server)
+        pub.handle_client_message(
+            watcher, json.dumps({"subscribe": {"jobs": True}}))
+        del pub.sent[:]
+
+        mon.handleGetCS(messages.GetCSMessage(b'b.c', 0, 7, 1))
+        mon.handleJobBegin(messages.JobBeginMessage(7, 0, 1))
+        mon.handleJobDone(messages.JobDoneMessage(7, 0, 1500, 0, 0, 0,
+                                                  0, 0, 0, 0, 0))
+        pub.publish(mon)
+
+        frames = dict((c, json.loads(f)) for c, f in pub.sent)
+        self.assertNotIn("jobs", frames.get(2, {}))
+        jobs = frames[1]["jobs"]
+        self.assertEqual([e["event"] for e in jobs["events"]],
+                         ["begin", "done"])
+        self.assertEqual(jobs["events"][1]["real_ms"], 1500)
+        self.assertEqual(jobs["events"][1]["file"], "b.c")
+        self.assertEqual((jobs["begun"], jobs["done"]), (1, 1))
+        self.assertEqual(jobs["hosts"], {"1": [1, 1]})
+
+    def test_sampled_per_view(self):
+        """Test that a view of a quiet host isn't drowned by a busy one."""
+        mon = Monitor(DummyConnection())
+        pub = RecordingPublisher()
+        add_cs(mon, 1, "busy", "10.1.0.1")
+        add_cs(mon, 2, "quiet", "10.1.0.2")
+        pub.publish(mon)
+
+        busy, quiet = {"id": 1}, {"id": 2}
+        for client, names in ((busy, ["busy"]), (quiet, ["quiet"])):
+            pub.ws_server.new_client(client, pub.ws_server)
+            pub.handle_client_message(client, json.dumps(
+                {"subscribe": {"names": names, "jobs": True,
+                               "links": "internal"}}))
+        del pub.sent[:]
+
+        # All in one tick.
+        for i in range(1000):
+            host = 2 if i % 200 == 0 else 1
+            mon.handleLocalJobBegin(
+                messages.LocalJobBeginMessage(i, host, 0, b'a.c'))
+            pub.publish_job_event("begin", mon.jobs[i])
+        pub.broadcast()
+
+        frames = dict((c, json.loads(f)) for c, f in pub.sent)
+        self.assertEqual(len(frames[1]["jobs"]["events"]),
+                         pub.MAX_JOB_EVENTS_PER_FRAME)
+        self.assertTrue(frames[1]["jobs"]["sampled"])
+        self.assertEqual(frames[1]["jobs"]["begun"], 995)
+        self.assertEqual(frames[1]["jobs"]["hosts"], {"1": [995, 0]})
+        self.assertEqual(len(frames[2]["jobs"]["events"]), 5)
+        self.assertFalse(frames[2]["jobs"]["sampled"])
+
+
+@unittest.skipIf(layout.numpy is None, "numpy not installed")
+class TestLayout(unittest.TestCase):
+
+    def settle(self, l):
+        while not l.converged():
+            l.step()
+
+    def test_converges_in_unit_square(self):
+        l = layout.ForceLayout()
+        l.update(range(50), [(i, i + 1) for i in range(49)])
+        self.settle(l)
+        for _, x, y in l.positions():
+            self.assertTrue(0 <= x <= 1 and 0 <= y <= 1)
+
+    def test_warm_start(self):
+        """Test that only nodes near a change move when a node is added."""
+        l = layout.ForceLayout()
+        l.update(range(50), [(i, i + 1) for i in range(49)])
+        fresh_steps = 0
+        while not l.converged():
+            l.step()
+            fresh_steps += 1
+        before = dict((i, (x, y)) for i, x, y in l.positions())
+
+        l.update(range(51), [(i, i + 1) for i in range(50)])
+        self.assertEqual(l.temperature.nonzero()[0].tolist(), [49, 50])
+        warm_steps = 0
+        while not l.converged():
+            l.step()
+            warm_steps += 1
+        self.assertLess(warm_steps, fresh_steps)
+
+        after = dict((i, (x, y)) for i, x, y in l.positions())
+        for i in range(49):
+            self.assertEqual(after[i], before[i])
+        self.assertLess(abs(after[49][0] - before[49][0]), 0.1)
+        self.assertLess(abs(after[49][1] - before[49][1]), 0.1)
+
+    def test_link_change_reheats_ends(self):
+        l = layout.ForceLayout()
+        l.update(range(4), [(0, 1), (1, 2)])
+        self.settle(l)
+        l.update(range(4), [(0, 1), (2, 3)])
+        self.assertEqual(l.temperature.nonzero()[0].tolist(), [1, 2, 3])
+
+    def test_remove_node(self):
+        l = layout.ForceLayout()
+        l.update([1, 2, 3], [(1, 2), (2, 3)])
+        l.update([1, 3], [(1, 2), (2, 3)])
+        self.assertEqual(l.ids, [1, 3])
+        self.assertEqual(len(l.edges), 0)
+
+    def test_publish_positions(self):
+        mon = Monitor(DummyConnection())
+        add_cs(mon, 1, "build-1", "10.1.0.1")
+        add_cs(mon, 2, "build-2", "10.1.0.2")
+        pub = RecordingPublisher(layout=layout.ForceLayout())
+        pub.ws_server.new_client({"id": 1}, pub.ws_server)
+        pub.publish(mon)
+        pub.step_layout()
+
+        frame = json.loads(pub.sent[-1][1])
+        self.assertEqual(sorted(p[0] for p in frame["layout"]), [1, 2])
+
+    def test_layout_stops_when_only_loads_change(self):
+        mon = Monitor(DummyConnection())
+        add_cs(mon, 1, "build-1", "10.1.0.1")
+        add_cs(mon, 2, "build-2", "10.1.0.2")
+        pub = RecordingPublisher(layout=layout.ForceLayout())
+        pub.publish(mon)
+        pub.step_layout()
+        while not pub.layout.converged():
+            pub.step_layout()
+
+        mon.handleLocalJobBegin(
+            messages.LocalJobBeginMessage(1, 1, 0, b'a.c'))
+        pub.publish(mon)
+        self.assertIsNone(pub.layout_graph)
+
+        positions = pub.layout_positions
+        pub.step_layout()
+        self.assertIs(pub.layout_positions, positions)
+
+        mon.handleGetCS(messages.GetCSMessage(b'b.c', 0, 7, 1))
+        mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+        pub.publish(mon)
+        self.assertIsNotNone(pub.layout_graph)
+
+
+class TestBinaryFrames(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = Monitor(DummyConnection())
+        add_cs(self.mon, 1, "build-1", "10.1.0.1")
+        add_cs(self.mon, 2, "b\u00fcild-2", "10.1.0.2")
+        self.mon.handleGetCS(messages.GetCSMessage(b'b.c', 0, 7, 1))
+        self.mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+
+    def test_round_trip(self):
+        add_cs(self.mon, 3, "build-3", "10.1.0.3", maxjobs=3)
+        self.mon.handleLocalJobBegin(
+            messages.LocalJobBeginMessage(8, 3, 0, b'a.c'))
+        view = GraphView(Subscription())
+        view.update(cluster_nodes(self.mon), cluster_links(self.mon))
+        view.update_layout([[1, 0.0, 1.0]])
+
+        frame = binaryframe.Decoder().decode(binaryframe.encode(view, True))
+        expected = json.loads(view.build_graph(True))
+        self.assertEqual(frame["nodes"], expected["nodes"])
+        self.assertEqual(frame["nodes"][2]["load"], 33.33)
+        self.assertEqual(frame["links"], expected["links"])
+        self.assertEqual(frame["layout"], [[1, 0.0, 1.0]])
+
+    def test_string_table_sent_once(self):
+        pub = RecordingPublisher()
+        pub.publish(self.mon)
+        client = {"id": 1}
+        pub.ws_server.new_client(client, pub.ws_server)
+        pub.handle_client_message(client, '{"encoding": "binary"}')
+
+        decoder = binaryframe.Decoder()
+        decoder.decode(pub.sent[-1][1])
+        self.assertEqual(len(decoder.table), 2)
+
+        self.mon.handleJobDone(messages.JobDoneMessage(7, 0, 0, 0, 0, 0,
+                                                       0, 0, 0, 0, 0))
+        pub.publish(self.mon)
+        data = pub.sent[-1][1]
+        self.assertFalse(bytearray(data)[1] & binaryframe.TABLE)
+        frame = decoder.decode(data)
+        self.assertEqual(sorted((n["name"], n["load"]) for n in frame["nodes"]),
+                         [("build-1", 0), ("b\u00fcild-2", 0)])
+        self.assertEqual(frame["links"], [])
+
+    def test_send_binary(self):
+        class Handler(object):
+            def __init__(self):
+                self.request = self
+                self.data = b''
+
+            def sendall(self, data):
+                self.data += data
+
+        pub = RecordingPublisher()
+        client = {"id": 1, "handler": Handler()}
+        WebsocketPublisher.send_binary(pub, client, b'abc')
+        self.assertEqual(client["handler"].data, b'')
+
+        client["handler"]._send_lock = threading.Lock()
+        WebsocketPublisher.send_binary(pub, client, b'abc')
+        self.assertEqual(client["handler"].data, b'\x82\x03abc')
+
+    def test_binary_needs_send_lock(self):
+        pub = RecordingPublisher()
+        pub.publish(self.mon)
+        client = {"id": 1, "handler": object()}
+        pub.ws_server.new_client(client, pub.ws_server)
+        pub.handle_client_message(client, '{"encoding": "binary"}')
+        self.assertEqual(pub.encoding(client), "json")
+        self.assertIsInstance(pub.sent[-1][1], str)
+
+    def test_bad_encoding(self):
+        pub = RecordingPublisher()
+        client = {"id": 1}
+        pub.ws_server.new_client(client, pub.ws_server)
+        pub.handle_client_message(client, '{"encoding": "xml"}')
+        self.assertEqual(pub.encoding(client), "json")
+
+
+@unittest.skipIf(clusterstate.numpy is None, "numpy not installed")
+class TestClusterState(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = Monitor(DummyConnection(), columnar=True)
+        for i in range(1, 5):
+            add_cs(self.mon, i, "cs{0}".format(i), "1.1.1.{0}".format(i))
+        job = 1
+        for client, host in ((1, 2), (1, 2), (1, 3), (2, 3), (4, 4)):
+            self.mon.handleGetCS(
+                messages.GetCSMessage(b'file.c', 0, job, client))
+            self.mon.handleJobBegin(messages.JobBeginMessage(job, 0, host))
+            job += 1
+        self.mon.handleLocalJobBegin(
+            messages.LocalJobBeginMessage(job, 1, 0, b'link'))
+
+    def done(self, job_id):
+        self.mon.handleJobDone(messages.JobDoneMessage(job_id, 0, 0, 0, 0, 0,
+                                                       0, 0, 0, 0, 0))
+
+    def assertInSync(self):
+        state, self.mon.state = self.mon.state, None
+        nodes, links = cluster_nodes(self.mon), cluster_links(self.mon)
+        self.mon.state = state
+        key = lambda d: sorted(d.items())
+        self.assertEqual(sorted(map(key, cluster_nodes(self.mon))),
+                         sorted(map(key, nodes)))
+        self.assertEqual(sorted(map(key, cluster_links(self.mon))),
+                         sorted(map(key, links)))
+
+    def test_queries(self):
+        state = self.mon.state
+        self.assertEqual(state.total_capacity(), 16)
+        self.assertEqual(state.total_active(), 6)
+        self.assertEqual(state.utilisation(), 6 / 16.0)
+        self.assertEqual(sorted(state.busiest(2)), [(2, 50.0), (3, 50.0)])
+        self.assertEqual(state.jobs_per_client(), {1: 4, 2: 1, 4: 1})
+        self.assertInSync()
+
+    def test_remove(self):
+        self.done(1)
+        self.done(3)
+        self.mon.handleLocalJobDone(messages.LocalJobDoneMessage(6))
+        self.assertEqual(self.mon.state.jobs_per_client(), {1: 1, 2: 1, 4: 1})
+        self.assertInSync()
+
+        offline = messages.StatsMessage(3, b'State:Offline')
+        self.mon.handleStats(offline)
+        self.assertEqual(self.mon.state.total_capacity(), 12)
+        self.assertInSync()
+
+    def test_jobs_stored_in_columns(self):
+        self.assertIsInstance(self.mon.jobs, clusterstate.JobTable)
+        job = self.mon.jobs[2]
+        self.assertEqual((job.client_id, job.host_id, job.filename, job.local),
+                         (1, 2, b'file.c', False))
+        self.assertIsNotNone(job.started_at)
+        self.assertTrue(self.mon.jobs[6].local)
+        self.assertEqual(sorted(self.mon.jobs), [1, 2, 3, 4, 5, 6])
+
+        self.done(2)
+        self.assertNotIn(2, self.mon.jobs)
+        self.assertRaises(KeyError, lambda: self.mon.jobs[2])
+        self.assertEqual(self.mon.jobs[5].host_id, 4)
+
+    def test_growth(self):
+        for job in range(100, 300):
+            self.mon.handleGetCS(messages.GetCSMessage(b'f.c', 0, job, 2))
+            self.mon.handleJobBegin(messages.JobBeginMessage(job, 0, 1))
+        self.assertEqual(self.mon.state.jobs_per_client()[2], 201)
+        self.assertInSync()
+
+
+class TestLatency(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.real_monotonic = monitor.monotonic
+        monitor.monotonic = lambda: self.now
+
+    def tearDown(self):
+        monitor.monotonic = self.real_monotonic
+
+    def test_histogram(self):
+        h = Histogram()
+        for ms in (0.5, 3, 3, 3, 100):
+            h.add(ms / 1000.0)
+        self.assertEqual(h.count, 5)
+        self.assertEqual(h.buckets[0], 1)
+        self.assertEqual(h.buckets[2], 3)
+        self.assertEqual(h.percentile(50), 0.004)
+        self.assertEqual(h.percentile(100), 0.1)
+        self.assertIsNone(Histogram().percentile(50))
+
+    def test_wait_and_run(self):
+        m = Monitor(DummyConnection())
+        add_cs(m, 1, "cs1", "1.1.1.1")
+        add_cs(m, 2, "cs2", "1.1.1.2")
+
+        m.handleGetCS(messages.GetCSMessage(b'file.c', 0, 7, 1))
+        self.now += 2
+        m.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+        self.now += 30
+        m.handleJobDone(messages.JobDoneMessage(7, 0, 0, 0, 0, 0,
+                                                0, 0, 0, 0, 0))
+
+        self.assertEqual(m.latency.client_wait[1].total, 2)
+        self.assertEqual(m.latency.host_wait[2].total, 2)
+        self.assertEqual(m.latency.client_run[1].total, 30)
+        self.assertEqual(m.latency.host_run[2].total, 30)
+        self.assertEqual(m.latency.wait.count, 1)
+        self.assertEqual(m.latency.summary()["run"]["max"], 30)
+
+    def test_placement_anomaly(self):
+        m = Monitor(DummyConnection())
+        add_cs(m, 1, "cs1", "1.1.1.1", maxjobs=1)
+        for job in (1, 2):
+            m.handleGetCS(messages.GetCSMessage(b'file.c', 0, job, 5))
+            m.handleJobBegin(messages.JobBeginMessage(job, 0, 1))
+
+        self.assertEqual(m.latency.placements, 2)
+        self.assertEqual(m.latency.anomaly_count, 1)
+        self.assertEqual(m.latency.anomalies[0]["job"], 2)
+        self.assertEqual(m.latency.anomalies[0]["active"], 1)
+
+
+def wire_string(s):
+    """Encode a string as the scheduler does, including its terminator."""
+    return struct.pack("!L", len(s) + 1) + s + b'\x00'
+
+
+class FrameConnection(DummyConnection):
+    """Connection which returns the given frames, then fails."""
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+
+    def get_frame(self):
+        if not self.frames:
+            raise EOFError()
+        return self.frames.pop(0)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def run_pipeline(self, processes):
+        frames = []
+        for i in range(1, 21):
+            body = 'Name:cs{0}\nIP:1.1.1.{0}\nMaxJobs:4'.format(i).encode()
+            frames.append(struct.pack("!LL", messages.StatsMessage.msg_type,
+                                      i) + wire_string(body))
+            frames.append(struct.pack("!LLLL",
+                                      messages.LocalJobBeginMessage.msg_type,
+                                      i, 100 + i, 0) + wire_string(b'a.o'))
+        for i in range(1, 11):
+            frames.append(struct.pack("!LL",
+                                      messages.LocalJobDoneMessage.msg_type,
+                                      100 + i))
+
+        mon = Monitor(FrameConnection(frames))
+        p = Pipeline(mon, processes=processes, queue_size=4)
+        if p.pool is not None:
+            self.addCleanup(p.pool.join)
+            self.addCleanup(p.pool.terminate)
+        self.assertRaises(EOFError, p.run)
+
+        # Every message was applied, in order.
+        self.assertEqual(len(mon.cs), 20)
+        self.assertEqual(sorted(mon.jobs), list(range(111, 121)))
+        self.assertEqual(mon.cs[15].active_jobs(), 1)
+        self.assertEqual(mon.cs[5].active_jobs(), 0)
+
+        metrics = p.metrics()
+        self.assertEqual(metrics["stages"]["apply"]["count"], 50)
+        self.assertEqual(metrics["queues"], {"frames": 0, "decoded": 0})
+        self.assertEqual(metrics["bottleneck"], "read")
+
+    def test_inline_decode(self):
+        self.run_pipeline(processes=0)
+
+    def test_process_decode(self):
+        self.run_pipeline(processes=1)
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.mon = Monitor(DummyConnection())
+        self.pub = SnapshotPublisher(host="127.0.0.1", port=0)
+        # Rebuild on every request, except where a test is timing rebuilds.
+        self.pub.MIN_REBUILD_GAP_S = 0
+        self.url = "http://127.0.0.1:{0}/snapshot".format(
+            self.pub.http_server.server_address[1])
+        add_cs(self.mon, 1, "cs1", "1.1.1.1")
+        add_cs(self.mon, 2, "cs2", "1.1.1.2")
+        self.mon.handleGetCS(messages.GetCSMessage(b'file.c', 0, 7, 1))
+        self.pub.publish(self.mon)
+
+    def tearDown(self):
+        self.pub.http_server.shutdown()
+        self.pub.http_server.server_close()
+
+    def get(self, query="", etag=None):
+        request = Request(self.url + query)
+        if etag is not None:
+            request.add_header("If-None-Match", etag)
+        try:
+            response = urlopen(request, timeout=5)
+        except HTTPError as e:
+            return e.code, e.headers.get("ETag"), None
+        return (response.getcode(), response.headers.get("ETag"),
+                json.loads(response.read().decode("utf-8")))
+
+    def version(self, n):
+        return "{0}-{1}".format(self.pub.epoch, n)
+
+    def test_snapshot(self):
+        status, etag, body = self.get()
+        self.assertEqual(status, 200)
+        self.assertEqual(etag, '"{0}"'.format(self.version(1)))
+        self.assertEqual(body["version"], self.version(1))
+        self.assertEqual(len(body["nodes"]), 2)
+        self.assertEqual(body["jobs"], {"total": 1, "local": 0,
+                                        "remote": 1, "pending": 1})
+
+    def test_not_modified(self):
+        _, etag, _ = self.get()
+        self.assertEqual(self.get(etag=etag)[0], 304)
+
+        # Publishing an unchanged state doesn't change the version.
+        self.pub.publish(self.mon)
+        self.assertEqual(self.get(etag=etag)[0], 304)
+
+        self.mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+        self.pub.publish(self.mon)
+        status, new_etag, body = self.get(etag=etag)
+        self.assertEqual((status, new_etag),
+                         (200, '"{0}"'.format(self.version(2))))
+        self.assertEqual(body["links"],
+                         [{"source": 1, "target": 2, "value": 10}])
+
+    def test_serialised_once(self):
+        first = self.pub.snapshot()[1]
+        self.assertIs(self.pub.snapshot()[1], first)
+
+    def test_long_poll(self):
+        def change():
+            self.mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+            self.pub.publish(self.mon)
+        threading.Timer(0.1, change).start()
+
+        status, etag, body = self.get("?wait=" + self.version(1))
+        self.assertEqual((status, body["version"]), (200, self.version(2)))
+
+    def test_restart(self):
+        """Test that versions from an earlier process never match."""
+        _, etag, _ = self.get()
+        self.pub.epoch = str(int(self.pub.epoch) + 1)
+        self.assertEqual(self.get(etag=etag)[0], 200)
+
+        start = time.time()
+        status, _, body = self.get("?wait=1-1")
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(body["version"], self.version(1))
+
+    def test_publish_is_lazy(self):
+        self.mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+        self.pub.publish(self.mon)
+        self.assertEqual(self.pub.version, 0)
+        self.assertEqual(self.pub.snapshot()[0], self.version(1))
+
+    def test_latency(self):
+        self.mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+        self.url = self.url.replace("/snapshot", "/latency")
+        status, _, body = self.get()
+        self.assertEqual(status, 200)
+        self.assertEqual(body["wait"]["count"], 1)
+        self.assertEqual(list(body["host_wait"]), ["2"])
+
+    def test_rebuild_gap(self):
+        """Test that a busy monitor is only read every MIN_REBUILD_GAP_S."""
+        self.pub.MIN_REBUILD_GAP_S = 60
+        self.assertEqual(self.pub.snapshot()[0], self.version(1))
+
+        self.mon.handleJobBegin(messages.JobBeginMessage(7, 0, 2))
+        self.pub.publish(self.mon)
+        self.assertEqual(self.pub.snapshot()[0], self.version(1))
+
+        self.pub.built_at -= 60
+        self.assertEqual(self.pub.snapshot()[0], self.version(2))
+
+    @unittest.skipIf(clusterstate.numpy is None, "numpy not installed")
+    def test_columnar_while_monitor_runs(self):
+        """Test that snapshots of columnar state are consistent."""
+        mon = Monitor(DummyConnection(), columnar=True)
+        mon.addPublisher(self.pub)
+        for host in range(1, 21):
+            add_cs(mon, host, "cs{0}".format(host), "1.1.1.{0}".format(host))
+
+        def run_jobs():
+            for job in range(1, 3001):
+                mon.handleMessage(messages.LocalJobBeginMessage(
+                    job, 1 + job % 20, 0, b'a.c'))
+                if job > 100:
+                    mon.handleMessage(messages.LocalJobDoneMessage(job - 100))
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            writer = threading.Thread(target=run_jobs)
+            writer.start()
+            while writer.is_alive():
+                body = json.loads(self.pub.snapshot()[1].decode("utf-8"))
+                self.assertEqual(len(body["nodes"]), 20)
+                self.assertEqual(body["jobs"]["total"], body["jobs"]["local"])
+            writer.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        body = json.loads(self.pub.snapshot()[1].decode("utf-8"))
+        self.assertEqual(body["jobs"]["total"], 100)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get("?wait=x")[0], 400)
+        self.assertEqual(self.get("?wait=2")[0], 400)
+        self.url = self.url.replace("/snapshot", "/nothing")
+        self.assertEqual(self.get()[0], 404)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -16,7 +16,7 @@ import sys
 import os
 import logging
 from monitor import Monitor
-from publishers import WebsocketPublisher
+from publishers import WebsocketPublisher, SnapshotPublisher
 from connection import Connection
 
 PORT = 80
@@ -36,4 +36,5 @@ if __name__ == "__main__":
     host, port = sys.argv[1], sys.argv[2]
     mon = Monitor(Connection(host, int(port)))
     mon.addPublisher(WebsocketPublisher(port=9999))
+    mon.addPublisher(SnapshotPublisher(port=9998))
     mon.run()